@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+"""
+Usage:
+  bench_e2e.py server [options]
+  bench_e2e.py runner [options]
+
+Measures kubeline end to end on one machine.
+
+server mode generates local bare git repos and a config file with a pipeline
+for each, then runs load_pipelines, one poll cycle after a new commit was
+pushed to every repo, and the dispatch workers against a stand-in k8s API
+(see fake_k8s.py). Each pipeline count runs in its own process, reporting
+startup time, poll cycle time, commit to Job create latency and peak memory.
+
+runner mode runs job-runner/main.py for one stage against a stand-in InfluxDB
+listening on 127.0.0.1:8086, and measures how many log lines per second it
+ships.
+
+Options:
+  --pipelines=<counts>      comma separated pipeline counts [default: 10,100,1000]
+  --workers=<n>             check and dispatch workers [default: 8]
+  --lines=<n>               log lines written by the stage in runner mode [default: 50000]
+  --count=<n>               run a single measurement and print it as json
+  -h --help                 show this help text
+
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from docopt import docopt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import chdir
+from os.path import abspath, dirname, exists, join
+from resource import getrusage, RUSAGE_SELF
+from shutil import copytree
+from statistics import median, quantiles
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import monotonic, sleep
+import json
+import subprocess
+import sys
+import yaml
+
+root_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+kubeline_yml = '''
+stages:
+- name: build
+  type: docker-build
+- name: test
+  type: custom
+  image: alpine:3.9
+  commands:
+  - make test
+'''
+
+def git(*args, cwd=None):
+    return subprocess.run(['git', *args], cwd=cwd, check=True,
+                          capture_output=True, text=True).stdout.strip()
+
+def make_repos(tmp_dir, count):
+    src = join(tmp_dir, 'src')
+    git('init', '-q', src)
+    with open(join(src, 'kubeline.yml'), 'w') as stream:
+        stream.write(kubeline_yml)
+    git('add', 'kubeline.yml', cwd=src)
+    git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+        'commit', '-q', '-m', 'initial commit', cwd=src)
+    git('branch', '-M', 'master', cwd=src)
+    template = join(tmp_dir, 'template.git')
+    git('clone', '-q', '--bare', src, template)
+    repos = {}
+    for idx in range(count):
+        repos[f'bench-{idx}'] = join(tmp_dir, 'repos', f'bench-{idx}.git')
+        copytree(template, repos[f'bench-{idx}'])
+    return repos
+
+def push_commit(repo):
+    commit = git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+                 'commit-tree', 'HEAD^{tree}', '-p', 'HEAD', '-m', 'bench',
+                 cwd=repo)
+    git('update-ref', 'refs/heads/master', commit, cwd=repo)
+
+def run_server(count, workers):
+    from fake_k8s import FakeK8s
+    from history_funcs import init_history
+    from job_funcs import JobIndex
+    from kubernetes import client
+    from queue_funcs import JobQueue, PollScheduler
+    from store_funcs import init_store
+    import k8s_funcs
+    import main
+
+    chdir(root_dir)
+    tmp = TemporaryDirectory()
+    repos = make_repos(tmp.name, count)
+    config_file = join(tmp.name, 'config.yml')
+    with open(config_file, 'w') as stream:
+        yaml.dump({'pipelines': {name: {'git_url': path, 'branch': 'master'}
+                                 for name, path in repos.items()}}, stream)
+
+    fake = FakeK8s().start()
+    api_client = fake.api_client()
+    k8s_funcs.api.update(client=api_client,
+                         batch=client.BatchV1Api(api_client),
+                         core=client.CoreV1Api(api_client),
+                         coordination=client.CoordinationV1Api(api_client))
+    main.args = docopt(main.__doc__, argv=[
+        f'--config-file={config_file}', '--influxdb-host=127.0.0.1',
+        '--namespace=bench', f'--check-workers={workers}',
+        f'--dispatch-workers={workers}', '--api-write-rate=0'])
+    main.namespace = 'bench'
+    main.pool = ThreadPoolExecutor(max_workers=workers)
+    main.shard = None
+    main.config_stat = None
+    main.config_checksum = None
+    init_store(join(tmp.name, 'kubeline.db'), 10000)
+    init_history(20, 500)
+
+    log_path = join(tmp.name, 'kubeline.log')
+    with open(log_path, 'w') as log, redirect_stdout(log):
+        start = monotonic()
+        main.check_config_file()
+        main.pipelines = main.load_pipelines()
+        startup = monotonic() - start
+
+        main.queue = JobQueue(admit=main.admit)
+        main.job_index = JobIndex(k8s_funcs.get_api()['batch'], 'bench',
+                                  on_change=main.queue.wake)
+        Thread(target=main.job_index.run, daemon=True).start()
+        main.job_index.synced.wait()
+
+        pushed = {}
+        for name, repo in repos.items():
+            push_commit(repo)
+            pushed[name] = monotonic()
+
+        scheduler = PollScheduler()
+        for name in main.pipelines:
+            scheduler.schedule(name, 0)
+        start = monotonic()
+        due = main.poll_cycle(scheduler, start, timeout=30)
+        poll = monotonic() - start
+        for _ in range(workers):
+            Thread(target=main.queue_watcher, daemon=True).start()
+        created = fake.wait_for_created(count, timeout=600)
+
+    latencies = [fake.created[name] -
+                 pushed[job['metadata']['labels']['pipeline']]
+                 for name, job in fake.jobs.items()]
+    with open(log_path) as log:
+        errors = [line.strip() for line in log if line.startswith('ERROR')]
+    fake.stop()
+    tmp.cleanup()
+    return {
+        'pipelines': count,
+        'checked': len(due),
+        'created': created,
+        'errors': errors[:5],
+        'startup': startup,
+        'poll': poll,
+        'latency_p50': median(latencies) if latencies else None,
+        'latency_p95': quantiles(latencies, n=20)[-1]
+                       if len(latencies) > 1 else None,
+        'peak_mb': getrusage(RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+def server_mode():
+    print(f'{"pipelines":>9} {"startup s":>10} {"poll s":>8} '
+          f'{"p50 s":>7} {"p95 s":>7} {"jobs":>6} {"peak MB":>8}')
+    for count in [int(n) for n in args['--pipelines'].split(',')]:
+        output = subprocess.run([sys.executable, abspath(__file__), 'server',
+                                 f'--count={count}',
+                                 f'--workers={args["--workers"]}'],
+                                check=True, capture_output=True, text=True)
+        result = json.loads(output.stdout.strip().splitlines()[-1])
+        p95 = result['latency_p95'] or result['latency_p50'] or 0
+        print(f'{count:>9} {result["startup"]:>10.2f} {result["poll"]:>8.2f} '
+              f'{result["latency_p50"] or 0:>7.2f} {p95:>7.2f} '
+              f'{result["created"]:>6} {result["peak_mb"]:>8.1f}')
+        for err in result['errors']:
+            print(f'  {err}')
+
+class InfluxHandler(BaseHTTPRequestHandler):
+    points = 0
+    requests = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        InfluxHandler.points += len(body.strip().split(b'\n'))
+        InfluxHandler.requests += 1
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+def runner_mode():
+    lines = int(args['--lines'])
+    server = ThreadingHTTPServer(('127.0.0.1', 8086), InfluxHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    with TemporaryDirectory() as log_dir:
+        log_file = join(log_dir, '1-bench')
+        runner = subprocess.Popen([sys.executable,
+            join(root_dir, 'job-runner', 'main.py'), 'bench',
+            '--stages=1-bench', f'--log-dir={log_dir}',
+            '--start=KUBELINE_STAGE_STARTING',
+            '--success=KUBELINE_STAGE_FINISHED',
+            '--failure=KUBELINE_STAGE_FAILURE',
+            '--influxdb-host=127.0.0.1', '--influxdb-db=kubeline',
+            '--time-limit=3600', '--iteration=1',
+            '--env-vars-file=kubeline-vars.sh'],
+            stdout=subprocess.DEVNULL)
+        while not exists(log_file):
+            sleep(0.01)
+        start = monotonic()
+        with open(log_file, 'a') as stream:
+            for idx in range(lines):
+                stream.write(f'bench log line {idx}\n')
+            stream.write('KUBELINE_STAGE_FINISHED\n')
+        runner.wait()
+        elapsed = monotonic() - start
+    server.shutdown()
+    assert InfluxHandler.points >= lines, InfluxHandler.points
+    print(f'{"lines":>8} {"requests":>9} {"seconds":>8} {"lines/s":>10}')
+    print(f'{lines:>8} {InfluxHandler.requests:>9} {elapsed:>8.2f} '
+          f'{lines / elapsed:>10.0f}')
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    if args['runner']:
+        runner_mode()
+    elif args['--count']:
+        result = run_server(int(args['--count']), int(args['--workers']))
+        print(json.dumps(result))
+    else:
+        server_mode()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Usage:
+  bench_render.py [options]
+
+Compares per-build Job manifest rendering through render_job against the
+previous path, which built a new jinja Environment and parsed the output with
+the pure python FullLoader on every build.
+
+Options:
+  --stages=<counts>         comma separated stage counts [default: 1,10,50]
+  --runs=<n>                number of renders per measurement [default: 200]
+  -h --help                 show this help text
+
+"""
+
+from docopt import docopt
+from jinja2 import Environment, FileSystemLoader, StrictUndefined
+from os import chdir
+from os.path import abspath, dirname
+from time import perf_counter
+import sys
+import yaml
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from k8s_funcs import format_dependencies, render_job, template_file, yaml_loader
+
+def uncached_render(build_spec):
+    env = Environment(loader=FileSystemLoader('.'), undefined=StrictUndefined)
+    template = env.get_template(template_file)
+    return yaml.load(template.render(build_spec), Loader=yaml.FullLoader)
+
+def make_build_spec(stage_count):
+    stages = []
+    for idx in range(stage_count):
+        if idx % 2:
+            stages.append({'name': f'test-{idx}', 'type': 'custom',
+                           'image': 'alpine:3.9',
+                           'commands': ['echo testing', 'make test']})
+        else:
+            stages.append({'name': f'build-{idx}', 'type': 'docker-build',
+                           'build_dir': '.', 'dockerfile': 'Dockerfile'})
+    return {
+        'job_runner_image': 'j18e/job-runner:latest',
+        'pipeline': 'bench',
+        'config': {'git_url': 'git@github.com:j18e/kubeline.git',
+                   'branch': 'master', 'docker_secret': 'bench'},
+        'commit': '0123456789abcdef0123456789abcdef01234567',
+        'iteration': 1,
+        'stages': stages,
+        'dependencies': format_dependencies(stages),
+        'influxdb_host': 'influxdb',
+        'influxdb_db': 'kubeline',
+        'git_key_secret': 'kubeline-git-key',
+        'clone_mode': 'full',
+        'workspace_medium': 'Memory',
+        'clone_cache_path': '/var/cache/kubeline/git',
+        'clone_cache_claim': None
+    }
+
+def measure(render, build_spec, runs):
+    start = perf_counter()
+    for _ in range(runs):
+        render(build_spec)
+    return (perf_counter() - start) / runs * 1000
+
+def main():
+    runs = int(args['--runs'])
+    chdir(dirname(dirname(abspath(__file__))))
+    print(f'yaml loader: {yaml_loader.__name__}')
+    print(f'{"stages":>8} {"old ms":>8} {"new ms":>8} {"speedup":>8}')
+    for stage_count in [int(n) for n in args['--stages'].split(',')]:
+        build_spec = make_build_spec(stage_count)
+        assert uncached_render(build_spec) == render_job(build_spec)
+        old = measure(uncached_render, build_spec, runs)
+        new = measure(render_job, build_spec, runs)
+        print(f'{stage_count:>8} {old:>8.2f} {new:>8.2f} {old / new:>7.1f}x')
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    main()
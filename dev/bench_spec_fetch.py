@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Usage:
+  bench_spec_fetch.py [options]
+
+Compares reading kubeline.yml through a full clone against the shallow,
+blobless fetch and the warm git mirror cache used by get_pipeline_spec. Bare
+repos are generated locally and served over file:// so that git uses its
+normal transport.
+
+Options:
+  --files=<counts>          comma separated file counts, one repo each [default: 10,500,2000]
+  --file-size=<kb>          size of each generated file in kilobytes [default: 32]
+  --commits=<n>             number of commits in each repo [default: 5]
+  --runs=<n>                number of runs per method [default: 3]
+  --work-dir=<dir>          directory for generated repos [default: tmp/bench]
+  -h --help                 show this help text
+
+"""
+
+from docopt import docopt
+from os import chdir, makedirs, urandom
+from os.path import abspath, dirname, join
+from shutil import rmtree
+from statistics import median
+from subprocess import run
+from time import monotonic
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from git_funcs import fetch_file, clone_file, mirror_file, init_mirror_cache
+
+spec = '''stages:
+- name: build
+  type: docker-build
+'''
+
+def git(*args, cwd=None):
+    run(['git', *args], cwd=cwd, check=True, capture_output=True)
+
+def make_repo(path, files, file_size, commits):
+    src = f'{path}.src'
+    makedirs(src)
+    git('init', '-q', cwd=src)
+    with open(join(src, 'kubeline.yml'), 'w') as stream:
+        stream.write(spec)
+    for commit in range(commits):
+        for idx in range(commit, files, commits):
+            with open(join(src, f'file-{idx}'), 'wb') as stream:
+                stream.write(urandom(file_size * 1024))
+        git('add', '.', cwd=src)
+        git('-c', 'user.name=bench', '-c', 'user.email=bench@localhost',
+            'commit', '-q', '-m', f'commit {commit}', cwd=src)
+    git('clone', '-q', '--bare', src, path)
+    git('config', 'uploadpack.allowFilter', 'true', cwd=path)
+    git('config', 'uploadpack.allowAnySHA1InWant', 'true', cwd=path)
+    rmtree(src)
+    head = run(['git', 'rev-parse', 'HEAD'], cwd=path, check=True,
+               capture_output=True, text=True)
+    return head.stdout.strip()
+
+def measure(method, url, commit, runs):
+    timings = []
+    for _ in range(runs):
+        start = monotonic()
+        contents, err = method(url, commit, 'kubeline.yml')
+        timings.append(monotonic() - start)
+        if err or contents is None:
+            print(f'ERROR {method.__name__}: {err}')
+    return median(timings)
+
+def main():
+    work_dir = abspath(args['--work-dir'])
+    file_size = int(args['--file-size'])
+    commits = int(args['--commits'])
+    runs = int(args['--runs'])
+    rmtree(work_dir, ignore_errors=True)
+    makedirs(work_dir)
+    chdir(dirname(dirname(abspath(__file__))))
+
+    init_mirror_cache(join(work_dir, 'mirrors'), 1024 * 1024)
+
+    print(f'{"files":>8} {"repo MB":>8} {"clone s":>8} {"fetch s":>8} '
+          f'{"mirror s":>8} {"speedup":>8}')
+    for files in [int(n) for n in args['--files'].split(',')]:
+        path = join(work_dir, f'repo-{files}.git')
+        commit = make_repo(path, files, file_size, commits)
+        size = run(['du', '-sm', path], check=True, capture_output=True,
+                   text=True).stdout.split()[0]
+        url = f'file://{path}'
+        clone_time = measure(clone_file, url, commit, runs)
+        fetch_time = measure(fetch_file, url, commit, runs)
+        mirror_file(url, commit, 'kubeline.yml')
+        mirror_time = measure(mirror_file, url, commit, runs)
+        print(f'{files:>8} {size:>8} {clone_time:>8.3f} {fetch_time:>8.3f} '
+              f'{mirror_time:>8.3f} {clone_time / fetch_time:>7.1f}x')
+    rmtree(work_dir)
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    main()
@@ -0,0 +1,166 @@
+"""
+A stand-in for the parts of the Kubernetes API that kubeline uses to manage
+Jobs: list, watch, create and delete in one namespace. Used by the benchmarks
+in this directory and the tests; created Jobs never run.
+"""
+
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from kubernetes import client
+from threading import Condition, Thread
+from time import monotonic
+from urllib.parse import parse_qs, urlparse
+import json
+
+class FakeK8s:
+    def __init__(self):
+        self.cond = Condition()
+        self.jobs = {}
+        self.events = []
+        self.created = {}
+        self.counter = count(1)
+        self.version = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), FakeK8sHandler)
+        self.server.daemon_threads = True
+        self.server.k8s = self
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        with self.cond:
+            self.cond.notify_all()
+
+    def api_client(self):
+        conf = client.Configuration()
+        conf.host = f'http://127.0.0.1:{self.server.server_port}'
+        return client.ApiClient(conf)
+
+    def record(self, event_type, job):
+        self.version += 1
+        job['metadata']['resourceVersion'] = str(self.version)
+        self.events.append((self.version, event_type, job))
+        self.cond.notify_all()
+
+    def create(self, job):
+        metadata = job['metadata']
+        with self.cond:
+            metadata['name'] = metadata.get('name') or \
+                f'{metadata["generateName"]}{next(self.counter):05d}'
+            metadata['creationTimestamp'] = \
+                datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+            job['status'] = {}
+            self.jobs[metadata['name']] = job
+            self.created[metadata['name']] = monotonic()
+            self.record('ADDED', job)
+        return job
+
+    def finish(self, name, succeeded=True, finished='2020-01-01T00:00:00Z'):
+        with self.cond:
+            job = self.jobs[name]
+            if succeeded:
+                job['status'] = {'succeeded': 1, 'completionTime': finished}
+            else:
+                job['status'] = {'failed': 1, 'conditions': [
+                    {'type': 'Failed', 'status': 'True',
+                     'lastTransitionTime': finished}]}
+            self.record('MODIFIED', job)
+        return job
+
+    def delete(self, name):
+        with self.cond:
+            job = self.jobs.pop(name, None)
+            if job:
+                self.record('DELETED', job)
+        return job
+
+    def wait_for_created(self, count, timeout):
+        deadline = monotonic() + timeout
+        with self.cond:
+            while len(self.created) < count and monotonic() < deadline:
+                self.cond.wait(deadline - monotonic())
+            return len(self.created)
+
+class FakeK8sHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def not_found(self):
+        self.send_json(404, {'kind': 'Status', 'apiVersion': 'v1',
+                             'status': 'Failure', 'reason': 'NotFound',
+                             'code': 404})
+
+    def route(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/')
+        if parts[:5] != ['apis', 'batch', 'v1', 'namespaces', parts[4]] or \
+                len(parts) < 6 or parts[5] != 'jobs':
+            return None, None, None
+        name = parts[6] if len(parts) > 6 else None
+        return self.server.k8s, name, parse_qs(url.query)
+
+    def do_GET(self):
+        k8s, name, query = self.route()
+        if not k8s or name:
+            return self.not_found()
+        if query.get('watch') == ['true']:
+            return self.watch(k8s, int(query.get('resourceVersion', ['0'])[0]),
+                              int(query.get('timeoutSeconds', ['60'])[0]))
+        with k8s.cond:
+            items = list(k8s.jobs.values())
+            version = str(k8s.version)
+        self.send_json(200, {'kind': 'JobList', 'apiVersion': 'batch/v1',
+                             'metadata': {'resourceVersion': version},
+                             'items': items})
+
+    def watch(self, k8s, version, timeout):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        deadline = monotonic() + timeout
+        while monotonic() < deadline:
+            with k8s.cond:
+                events = [event for event in k8s.events if event[0] > version]
+                if not events:
+                    k8s.cond.wait(min(deadline - monotonic(), 1))
+                    continue
+            for version, event_type, job in events:
+                line = json.dumps({'type': event_type, 'object': job}) + '\n'
+                data = line.encode('utf-8')
+                try:
+                    self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+                    self.wfile.flush()
+                except OSError:
+                    return
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_POST(self):
+        k8s, name, _ = self.route()
+        if not k8s or name:
+            return self.not_found()
+        length = int(self.headers['Content-Length'])
+        job = json.loads(self.rfile.read(length))
+        self.send_json(201, k8s.create(job))
+
+    def do_DELETE(self):
+        k8s, name, _ = self.route()
+        length = int(self.headers.get('Content-Length') or 0)
+        self.rfile.read(length)
+        if not k8s or not name or not k8s.delete(name):
+            return self.not_found()
+        self.send_json(200, {'kind': 'Status', 'apiVersion': 'v1',
+                             'status': 'Success'})
+
+    def log_message(self, *args):
+        pass
@@ -1,55 +1,93 @@
 from git import Repo, cmd
 from git.exc import GitCommandError
+from hashlib import sha1
 from k8s_funcs import validate_pipeline_spec, get_secret
-from os import environ, makedirs, chmod
+from metric_funcs import clone_time, ls_remote_time, spec_fetch_time
+from os import environ, makedirs, chmod, listdir, rename, utime, walk
 import os.path
-from random import randint
-from requests import get
-from requests.exceptions import HTTPError
+from requests import Session
+from requests.exceptions import HTTPError, RequestException
+from store_funcs import cache_file, get_cached_file
 from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Lock
+from time import monotonic
+from webhook_funcs import normalize_url
 import stat
 import yaml
 
 git_key_dir = './tmp/keys'
+repos_dir = 'tmp/repos'
+mirrors = {'dir': 'tmp/mirrors', 'max_size': 0, 'sizes': {}, 'locks': {}}
+mirrors_lock = Lock()
+http = {'session': Session(), 'ttl': 300, 'cache': {}}
+http_lock = Lock()
 git_key_path = f'{git_key_dir}/id_rsa'
 ssh_cmd = f'ssh -o StrictHostKeyChecking=no -i {git_key_path}'
 
-def check_http_auth(url):
+def init_http_check(ttl):
+    http['ttl'] = ttl
+
+def check_http_auth(url, timeout=None):
     if not url.startswith('https://'):
         return True, None
+    with http_lock:
+        cached = http['cache'].get(url)
+    if cached and monotonic() - cached[0] < http['ttl']:
+        return cached[1]
     try:
-        resp = get(url)
+        resp = http['session'].head(url, timeout=timeout, allow_redirects=True)
         resp.raise_for_status()
-        return True, None
+        result = True, None
     except HTTPError:
-        return False, f'{url} does not exist or requires auth'
+        result = False, f'{url} does not exist or requires auth'
+    except RequestException as err:
+        return False, f'{url} could not be reached: {err}'
+    with http_lock:
+        http['cache'][url] = monotonic(), result
+    return result
 
-def get_commit(config):
-    http_check, err = check_http_auth(config['git_url'])
+def get_refs(url, timeout=None):
+    http_check, err = check_http_auth(url, timeout=timeout)
     if err:
-        return False, err
-    url = config['git_url']
-    branch = config['branch']
+        return None, err
     client = cmd.Git()
     try:
-        with client.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
-            refs = client.ls_remote(url).split('\n')
-        refs = [ref.split('\t')[0] for ref in refs
-               if ref.split('\t')[1].split('/')[-1] == branch]
+        with client.custom_environment(GIT_SSH_COMMAND=ssh_cmd), \
+                ls_remote_time.labels(normalize_url(url)).time():
+            output = client.ls_remote('--heads', url,
+                                      kill_after_timeout=timeout)
     except GitCommandError as err:
-        return False, err
-    if len(refs) != 1:
+        return None, err
+    refs = {}
+    for line in output.splitlines():
+        commit, _, ref = line.partition('\t')
+        refs[ref[len('refs/heads/'):]] = commit
+    return refs, None
+
+def get_commit(config, timeout=None, refs=None):
+    if refs is None:
+        refs, err = get_refs(config['git_url'], timeout=timeout)
+        if err:
+            return False, err
+    if config['branch'] not in refs:
         return False, f'no commits found in branch {config["branch"]}'
-    return refs[0], None
+    return refs[config['branch']], None
 
-def clone_repo(url, git_ref, is_branch=False):
+@clone_time.time()
+def clone_repo(url, git_ref, is_branch=False, timeout=None):
     msg = f'{url} at {git_ref}'
-    if not check_http_auth(url):
-        return False, False, f'{msg}: cannot clone authenticated http repos'
-    repo_dir = str(randint(1000, 9999))
-    repo_path = 'tmp/repos/' + repo_dir
+    _, err = check_http_auth(url, timeout=timeout)
+    if err:
+        return None, None, f'{msg}: cannot clone authenticated http repos'
+    if not os.path.exists(repos_dir):
+        makedirs(repos_dir)
+    repo_path = mkdtemp(dir=repos_dir)
     try:
-        repo = Repo.clone_from(url, repo_path, env={'GIT_SSH_COMMAND': ssh_cmd})
+        client = cmd.Git()
+        with client.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
+            client.clone('-q', url, repo_path, kill_after_timeout=timeout)
+        repo = Repo(repo_path)
         if is_branch:
             if repo.active_branch == git_ref:
                 return repo_path, repo.head.commit.hexsha, None
@@ -59,27 +97,177 @@ def clone_repo(url, git_ref, is_branch=False):
         repo.head.reference = head
         repo.head.reset(index=True, working_tree=True)
     except GitCommandError as e:
+        rmtree(repo_path)
         return None, None, f'{msg}: {e}'
     except ValueError as e:
+        rmtree(repo_path)
         return None, None, f'{msg}: {e}'
     return repo_path, repo.head.commit.hexsha, None
 
-def get_pipeline_spec(config, commit=None):
-    file_name = 'kubeline.yml'
-    url = config['git_url']
-    if commit:
-        repo_path, commit, err = clone_repo(url, commit)
-    else:
-        repo_path, commit, err = clone_repo(url, config['branch'], is_branch=True)
+def init_mirror_cache(mirror_dir, max_size):
+    mirrors['dir'] = mirror_dir
+    mirrors['max_size'] = max_size * 1024 * 1024
+    if not max_size:
+        return
+    if not os.path.exists(mirror_dir):
+        makedirs(mirror_dir)
+    for name in listdir(mirror_dir):
+        if name.startswith('.'):
+            rmtree(f'{mirror_dir}/{name}')
+            continue
+        mirrors['sizes'][name] = get_dir_size(f'{mirror_dir}/{name}')
+    print(f'using git mirror cache {mirror_dir} of {max_size}MB, '
+          f'{len(mirrors["sizes"])} mirrors present')
+
+def get_dir_size(path):
+    size = 0
+    for root, _, files in walk(path):
+        for name in files:
+            file_path = os.path.join(root, name)
+            if not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+def get_mirror_lock(name):
+    with mirrors_lock:
+        if name not in mirrors['locks']:
+            mirrors['locks'][name] = Lock()
+        return mirrors['locks'][name]
+
+def evict_mirrors(keep):
+    with mirrors_lock:
+        total = sum(mirrors['sizes'].values())
+        if total <= mirrors['max_size']:
+            return
+        by_age = sorted(mirrors['sizes'], key=lambda name:
+                        os.path.getmtime(f'{mirrors["dir"]}/{name}'))
+        for name in by_age:
+            if total <= mirrors['max_size']:
+                break
+            lock = mirrors['locks'].setdefault(name, Lock())
+            if name == keep or not lock.acquire(blocking=False):
+                continue
+            print(f'evicting git mirror {name}')
+            rmtree(f'{mirrors["dir"]}/{name}', ignore_errors=True)
+            total -= mirrors['sizes'].pop(name)
+            lock.release()
+
+def update_mirror(url, name, commit, timeout=None):
+    path = f'{mirrors["dir"]}/{name}'
+    if not os.path.exists(path):
+        print(f'creating git mirror of {url}')
+        tmp_path = mkdtemp(dir=mirrors['dir'], prefix='.')
+        client = cmd.Git()
+        try:
+            with client.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
+                client.clone('-q', '--mirror', url, tmp_path,
+                             kill_after_timeout=timeout)
+        except GitCommandError as err:
+            rmtree(tmp_path)
+            return None, f'{url}: {err}'
+        rename(tmp_path, path)
+    client = cmd.Git(path)
+    try:
+        with client.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
+            if not has_commit(client, commit):
+                client.fetch('-q', '--prune', 'origin',
+                             kill_after_timeout=timeout)
+            if not has_commit(client, commit):
+                client.fetch('-q', 'origin', commit,
+                             kill_after_timeout=timeout)
+    except GitCommandError as err:
+        return None, f'{url} at {commit}: {err}'
+    utime(path)
+    size = get_dir_size(path)
+    with mirrors_lock:
+        mirrors['sizes'][name] = size
+    return path, None
+
+def has_commit(client, commit):
+    try:
+        client.cat_file('-e', f'{commit}^{{commit}}')
+    except GitCommandError:
+        return False
+    return True
+
+def mirror_file(url, commit, file_name, timeout=None):
+    name = sha1(url.encode('utf-8')).hexdigest()
+    with get_mirror_lock(name):
+        mirror_path, err = update_mirror(url, name, commit, timeout=timeout)
+        if err:
+            return None, err
+        client = cmd.Git(mirror_path)
+        try:
+            contents = None
+            if client.ls_tree(commit, file_name):
+                contents = client.cat_file('blob', f'{commit}:{file_name}')
+        except GitCommandError as err:
+            return None, f'{url} at {commit}: {err}'
+    evict_mirrors(keep=name)
+    return contents, None
+
+def fetch_file(url, commit, file_name, timeout=None):
+    if not os.path.exists(repos_dir):
+        makedirs(repos_dir)
+    repo_path = mkdtemp(dir=repos_dir)
+    client = cmd.Git(repo_path)
+    try:
+        with client.custom_environment(GIT_SSH_COMMAND=ssh_cmd):
+            client.init('--bare', '-q')
+            client.remote('add', 'origin', url)
+            client.fetch('-q', '--depth=1', '--filter=blob:none', '--no-tags',
+                         'origin', commit, kill_after_timeout=timeout)
+            if not client.ls_tree(commit, file_name):
+                return None, None
+            contents = client.cat_file('blob', f'{commit}:{file_name}',
+                                       kill_after_timeout=timeout)
+    except GitCommandError as err:
+        return None, f'{url} at {commit}: {err}'
+    finally:
+        rmtree(repo_path)
+    return contents, None
+
+def clone_file(url, commit, file_name, timeout=None):
+    repo_path, commit, err = clone_repo(url, commit, timeout=timeout)
     if err:
-        return None, None, err
+        return None, err
     path = f'{repo_path}/{file_name}'
-    if not os.path.isfile(path):
-        rmtree(repo_path)
-        return None, commit, f'did not find {file_name} in {url}'
-    with open(path, 'r') as stream:
-        config = yaml.load(stream.read(), Loader=yaml.FullLoader)
+    contents = None
+    if os.path.isfile(path):
+        with open(path, 'r') as stream:
+            contents = stream.read()
     rmtree(repo_path)
+    return contents, None
+
+@spec_fetch_time.time()
+def get_pipeline_spec(config, commit=None, timeout=None):
+    file_name = 'kubeline.yml'
+    url = config['git_url']
+    if not commit:
+        commit, err = get_commit(config, timeout=timeout)
+        if err:
+            return None, None, err
+    found, contents = get_cached_file(url, commit)
+    if not found:
+        if mirrors['max_size']:
+            contents, err = mirror_file(url, commit, file_name,
+                                        timeout=timeout)
+        else:
+            contents, err = fetch_file(url, commit, file_name,
+                                       timeout=timeout)
+        if err:
+            print(f'WARNING/spec: {err}, falling back to full clone')
+            contents, err = clone_file(url, commit, file_name,
+                                       timeout=timeout)
+        if err:
+            return None, None, err
+        cache_file(url, commit, contents)
+    if contents is None:
+        return None, commit, f'did not find {file_name} in {url}'
+    try:
+        config = yaml.load(contents, Loader=yaml.FullLoader)
+    except yaml.YAMLError as e:
+        return None, commit, f'could not parse {file_name} in {url}: {e}'
     config, err = validate_pipeline_spec(config)
     if err:
         return None, commit, err
@@ -0,0 +1,93 @@
+from collections import OrderedDict
+from hashlib import sha1
+from threading import Lock
+import json
+
+history = {'max_recent': 20, 'max_seen': 500}
+specs = {}
+specs_lock = Lock()
+
+def init_history(max_recent, max_seen):
+    history['max_recent'] = max(max_recent, 1)
+    history['max_seen'] = max_seen
+
+def intern_spec(spec):
+    if spec is None:
+        return None
+    blob = json.dumps(spec, sort_keys=True, default=str)
+    key = sha1(blob.encode('utf-8')).hexdigest()
+    with specs_lock:
+        entry = specs.setdefault(key, [spec, 0, len(blob)])
+        entry[1] += 1
+    return key
+
+def release_spec(key):
+    if key is None:
+        return
+    with specs_lock:
+        entry = specs[key]
+        entry[1] -= 1
+        if not entry[1]:
+            del specs[key]
+
+def get_spec(key):
+    with specs_lock:
+        entry = specs.get(key)
+    return entry[0] if entry else None
+
+def get_spec_usage():
+    with specs_lock:
+        return len(specs), sum(entry[2] for entry in specs.values())
+
+class CommitHistory:
+    def __init__(self):
+        self.lock = Lock()
+        self.recent = OrderedDict()
+        self.seen = OrderedDict()
+
+    def __contains__(self, commit):
+        with self.lock:
+            return commit in self.recent or commit in self.seen
+
+    def __len__(self):
+        with self.lock:
+            return len(self.recent)
+
+    def get(self, commit, default=None):
+        with self.lock:
+            if commit not in self.recent:
+                return default
+            self.recent.move_to_end(commit)
+            key = self.recent[commit]
+        spec = get_spec(key)
+        return default if spec is None else spec
+
+    def __setitem__(self, commit, spec):
+        key = intern_spec(spec)
+        released = []
+        with self.lock:
+            if commit in self.recent:
+                released.append(self.recent[commit])
+            self.seen.pop(commit, None)
+            self.recent[commit] = key
+            self.recent.move_to_end(commit)
+            while len(self.recent) > history['max_recent']:
+                old_commit, old_key = self.recent.popitem(last=False)
+                released.append(old_key)
+                self.seen[old_commit] = None
+            while len(self.seen) > history['max_seen']:
+                self.seen.popitem(last=False)
+        for old_key in released:
+            release_spec(old_key)
+
+    def seen_count(self):
+        with self.lock:
+            return len(self.seen)
+
+    def clear(self):
+        with self.lock:
+            released = list(self.recent.values())
+            self.recent.clear()
+            self.seen.clear()
+        for key in released:
+            release_spec(key)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+
+"""
+Usage:
+  bench_writer.py [options]
+
+Measures log shipping throughput against a local stand-in for the InfluxDB
+HTTP API, comparing one write_points call per line with BatchWriter, which
+spools points to a local file and ships them in batches.
+
+Options:
+  --lines=<n>               number of log lines to ship [default: 20000]
+  --batch-size=<n>          BatchWriter batch size [default: 5000]
+  -h --help                 show this help text
+
+"""
+
+from docopt import docopt
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from influxdb import InfluxDBClient
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import perf_counter
+import sys
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from main import BatchWriter
+
+class InfluxHandler(BaseHTTPRequestHandler):
+    points = 0
+    requests = 0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        InfluxHandler.points += len(body.strip().split(b'\n'))
+        InfluxHandler.requests += 1
+        self.send_response(204)
+        self.end_headers()
+
+    def do_GET(self):
+        body = b'{"results":[{"statement_id":0}]}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+def start_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), InfluxHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def reset():
+    InfluxHandler.points = 0
+    InfluxHandler.requests = 0
+
+def per_line(client, tags, lines):
+    for idx in range(lines):
+        client.write_points([{'measurement': 'job_logs', 'tags': tags,
+                              'fields': {'value': f'log line {idx}'}}])
+
+def batched(client, tags, lines):
+    with TemporaryDirectory() as spool_dir:
+        writer = BatchWriter(client, join(spool_dir, 'spool'),
+                             batch_size=int(args['--batch-size']))
+        for idx in range(lines):
+            writer.write('job_logs', tags, {'value': f'log line {idx}'})
+        writer.close()
+
+def main():
+    lines = int(args['--lines'])
+    server = start_server()
+    client = InfluxDBClient(host='127.0.0.1', port=server.server_port,
+                            database='kubeline')
+    tags = {'pipeline': 'bench', 'job': 'bench-1', 'stage': '1-build'}
+
+    print(f'{"method":>10} {"lines":>8} {"requests":>9} {"lines/s":>10}')
+    for method in [per_line, batched]:
+        reset()
+        start = perf_counter()
+        method(client, tags, lines)
+        elapsed = perf_counter() - start
+        assert InfluxHandler.points == lines
+        print(f'{method.__name__:>10} {lines:>8} {InfluxHandler.requests:>9} '
+              f'{lines / elapsed:>10.0f}')
+    server.shutdown()
+
+if __name__ == '__main__':
+    args = docopt(__doc__)
+    main()
@@ -5,14 +5,18 @@ Usage: main.py [options] PIPELINE (--stages=<names>) (--log-dir=<dir>)
            (--start=<string>) (--success=<string>) (--failure=<string>)
            (--influxdb-host=<host>) (--influxdb-db=<name>)
 
-Starting with the first provided stage name, Kfollow will provision a log file
-named for the stage itself, in the --log-dir directory. Kfollow will tail the
-log file until the --finish-string string is detected as the start of a line.
-It will then assume the stage is complete, and move onto the next stage.
+Once all of a stage's dependencies have succeeded, Kfollow will provision a log
+file named for the stage itself, in the --log-dir directory. Kfollow will tail
+the log file until the --finish-string string is detected as the start of a
+line. It will then assume the stage is complete, and start any stages depending
+on it. Independent stages are followed concurrently.
 
 Options:
   -h --help                             show this help text
   --stages=<names>                      comma separated list of stage names
+  --depends=<deps>                      dependencies of each stage, as
+                                        stage:dep,dep;stage:dep. stages run in
+                                        sorted order when not given
   --start=<string>                      string to signal stage start
   --success=<string>                    string to signal stage success
   --failure=<string>                    string to signal stage failure
@@ -21,24 +25,139 @@ Options:
   --time-limit=<seconds>                number of seconds before timing out job
   --log-dir=<dir>                       directory to write/read logs
   --env-vars-file=<file>                file inside log-dir to write env vars to
+  --iteration=<n>                       job iteration assigned by the kubeline server
+  --batch-size=<n>                      max points per influxdb write [default: 5000]
+  --flush-interval=<seconds>            max seconds between influxdb writes [default: 1]
+  --drain-timeout=<seconds>             max seconds to wait for influxdb at exit [default: 300]
+  --supersedable                        record SIGTERM as the job being superseded
+                                        by a newer commit rather than failing
+  --supersede-timeout=<seconds>         max seconds to wait for influxdb once
+                                        superseded [default: 20]
 """
 
 from datetime import datetime
 from docopt import docopt
 from influxdb import InfluxDBClient
-from os import environ, remove
-from os.path import isfile
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from ctypes import CDLL
+from os import close, environ, read, remove, replace
+from os.path import getsize, isfile
 from pathlib import Path
-from time import sleep
+from select import select
+from signal import signal, SIGTERM
+from threading import Condition, Thread
+from time import monotonic, sleep, time_ns
 from math import ceil
-from time import sleep
-from requests.exceptions import ConnectionError
-
-format_metric = lambda metric, tags, fields: [{'measurement': metric,
-    'tags': tags, 'fields': fields}]
+import json
+from requests.exceptions import ConnectionError, RequestException
 
 now = lambda : datetime.now().timestamp()
 
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_CLOEXEC = 0o2000000
+
+class Superseded(Exception):
+    pass
+
+def handle_sigterm(signum, frame):
+    raise Superseded()
+
+class BatchWriter:
+    def __init__(self, client, spool_path, batch_size=5000, interval=1):
+        self.client = client
+        self.spool_path = spool_path
+        self.offset_path = f'{spool_path}.offset'
+        self.batch_size = batch_size
+        self.interval = interval
+        self.cond = Condition()
+        self.pending = 0
+        self.flushing = False
+        self.closed = False
+        self.last_time = 0
+        self.offset = 0
+        if isfile(self.offset_path):
+            with open(self.offset_path, 'r') as stream:
+                self.offset = int(stream.read() or 0)
+        self.spool = open(spool_path, 'ab')
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def write(self, metric, tags, fields):
+        with self.cond:
+            self.last_time = max(time_ns(), self.last_time + 1)
+            point = {'measurement': metric, 'tags': tags, 'fields': fields,
+                     'time': self.last_time}
+            self.spool.write(json.dumps(point).encode('utf-8') + b'\n')
+            self.pending += 1
+            if self.pending >= self.batch_size:
+                self.cond.notify_all()
+
+    def flush(self):
+        with self.cond:
+            self.spool.flush()
+            self.flushing = True
+            self.cond.notify_all()
+
+    def close(self, timeout=None):
+        with self.cond:
+            self.spool.flush()
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            unshipped = getsize(self.spool_path) - self.offset
+            print(f'WARNING {unshipped} bytes of metrics were not shipped to '
+                  f'influxdb, see {self.spool_path}')
+        self.spool.close()
+
+    def run(self):
+        errors = 0
+        with open(self.spool_path, 'rb') as reader:
+            while True:
+                with self.cond:
+                    deadline = monotonic() + self.interval
+                    while self.pending < self.batch_size and \
+                            not self.flushing and not self.closed and \
+                            monotonic() < deadline:
+                        self.cond.wait(deadline - monotonic())
+                    self.spool.flush()
+                    self.pending = 0
+                    self.flushing = False
+                    closed = self.closed
+                drained, err = self.drain(reader)
+                if drained and closed:
+                    return
+                if err:
+                    errors += 1
+                    print(f'ERROR shipping metrics to influxdb: {err}')
+                    sleep(min(2 ** errors, 30))
+                else:
+                    errors = 0
+
+    def drain(self, reader):
+        while True:
+            reader.seek(self.offset)
+            lines = []
+            for line in reader:
+                if not line.endswith(b'\n'):
+                    break
+                lines.append(line)
+                if len(lines) >= self.batch_size:
+                    break
+            if not lines:
+                return True, None
+            points = [json.loads(line) for line in lines]
+            try:
+                self.client.write_points(points, time_precision='n')
+            except (RequestException, InfluxDBClientError,
+                    InfluxDBServerError) as err:
+                return False, err
+            self.offset += sum(len(line) for line in lines)
+            with open(f'{self.offset_path}.tmp', 'w') as stream:
+                stream.write(str(self.offset))
+            replace(f'{self.offset_path}.tmp', self.offset_path)
+
 def get_iteration(client, pipeline):
     query = f'select last("value"),iteration from "job_status" where \
             "pipeline" = \'{pipeline}\''
@@ -61,7 +180,36 @@ def wait_for_db(client):
             print('wating for influxdb to become available...')
             sleep(1)
 
-def follow_file(client, tags, file_path, stage_success=None):
+class FileWatcher:
+    def __init__(self, file_path, timeout=1):
+        self.timeout = timeout
+        self.fd = None
+        try:
+            libc = CDLL(None, use_errno=True)
+            fd = libc.inotify_init1(IN_CLOEXEC)
+            if fd < 0:
+                return
+            if libc.inotify_add_watch(fd, file_path.encode('utf-8'),
+                                      IN_MODIFY | IN_CLOSE_WRITE) < 0:
+                close(fd)
+                return
+            self.fd = fd
+        except (AttributeError, OSError):
+            print('inotify unavailable, polling for log changes')
+
+    def wait(self):
+        if self.fd is None:
+            sleep(min(self.timeout, 0.25))
+            return
+        ready, _, _ = select([self.fd], [], [], self.timeout)
+        if ready:
+            read(self.fd, 65536)
+
+    def close(self):
+        if self.fd is not None:
+            close(self.fd)
+
+def follow_file(writer, tags, file_path, stage_success=None):
     sig_start = args['--start']
     sig_success = args['--success']
     sig_failed = args['--failure']
@@ -72,22 +220,30 @@ def follow_file(client, tags, file_path, stage_success=None):
             return False
         stream.write('')
 
-    sleep_time = 0.01
-    line = ''
-
-    client.write_points(format_metric('job_logs', tags, {'value': sig_start}))
-    with open(file_path, 'r') as stream:
-        while not line.startswith(sig_success):
-            line = stream.readline().rstrip()
-            if not line:
-                continue
-            client.write_points(format_metric('job_logs', tags, {'value': line}))
-            print(line)
-            if line.startswith(sig_failed):
-                print('FAILURE FOUND IN', file_path)
-                return False
-            sleep(sleep_time)
-    return True
+    writer.write('job_logs', tags, {'value': sig_start})
+    watcher = FileWatcher(file_path)
+    buffer = b''
+    try:
+        with open(file_path, 'rb') as stream:
+            while True:
+                chunk = stream.read(65536)
+                if not chunk:
+                    watcher.wait()
+                    continue
+                *lines, buffer = (buffer + chunk).split(b'\n')
+                for line in lines:
+                    line = line.decode('utf-8', errors='replace').rstrip()
+                    if not line:
+                        continue
+                    writer.write('job_logs', tags, {'value': line})
+                    print(line)
+                    if line.startswith(sig_failed):
+                        print('FAILURE FOUND IN', file_path)
+                        return False
+                    if line.startswith(sig_success):
+                        return True
+    finally:
+        watcher.close()
 
 def write_env_vars(file_path, env_vars):
     contents = ''
@@ -103,18 +259,23 @@ def main():
     pipeline = args['PIPELINE']
     log_dir = args['--log-dir']
     stages = args['--stages'].split(',')
-    stages.sort()
-    stage_success = None
+    dependencies = parse_dependencies(stages, args['--depends'])
 
     client = InfluxDBClient(host=idb_host, database=database)
-    wait_for_db(client)
-
-    iteration = get_iteration(client, pipeline)
+    if args['--iteration']:
+        iteration = int(args['--iteration'])
+    else:
+        wait_for_db(client)
+        iteration = get_iteration(client, pipeline)
+    writer = BatchWriter(client, f'{log_dir}/.kubeline-spool',
+                         batch_size=int(args['--batch-size']),
+                         interval=float(args['--flush-interval']))
     fields = {
         'pending': {'value': -1, 'description': 'pending'},
         'failure': {'value':-2,'description':'failure'},
         'running': {'value':0,'description':'running'},
         'success': {'value':1,'description':'success'},
+        'superseded': {'value': -3, 'description': 'superseded'},
         'duration': {'value': None, 'description': 'seconds'}
     }
     job = f'{pipeline}-{iteration}'
@@ -130,45 +291,88 @@ def main():
     job_start_time = now()
 
     job_tags = {'pipeline': pipeline, 'job': job, 'iteration': iteration}
-    stage_tags = job_tags
-
-    status = format_metric('job_status', job_tags, fields['running'])
-    client.write_points(status)
-
-    for stage in stages:
-        stage_tags['stage'] = stage
-        client.write_points(format_metric('stage_duration', stage_tags,
-                                          fields['pending']))
-
-    for stage in stages:
-        print('starting', stage)
-        stage_tags['stage'] = stage
-        log_file = '{}/{}'.format(log_dir, stage)
-        stage_start_time = now()
-        metric = format_metric('stage_duration', stage_tags, fields['running'])
-        client.write_points(metric)
-        stage_success = follow_file(client, stage_tags, log_file,
-                                    stage_success=stage_success)
-        print(stage_success)
-        if stage_success:
-            print('writing stage success')
-            fields['duration']['value'] = ceil(now() - stage_start_time)
-            metric = format_metric('stage_duration', stage_tags,
-                                   fields['duration'])
-            client.write_points(metric)
-        else:
-            print('writing stage failure')
-            metric = format_metric('stage_duration', stage_tags,
-                                   fields['failure'])
-            client.write_points(metric)
-
-    if stage_success is True:
+
+    drain_timeout = int(args['--drain-timeout'])
+    if args['--supersedable']:
+        signal(SIGTERM, handle_sigterm)
+    try:
+        run_stages(writer, dependencies, job_tags, fields, log_dir)
+    except Superseded:
+        print('job superseded by a newer commit')
+        writer.write('job_status', job_tags, fields['superseded'])
+        drain_timeout = int(args['--supersede-timeout'])
+    finally:
+        writer.close(timeout=drain_timeout)
+
+def parse_dependencies(stages, depends):
+    if not depends:
+        ordered = sorted(stages)
+        return {stage: ordered[idx - 1:idx] if idx else []
+                for idx, stage in enumerate(ordered)}
+    dependencies = {stage: [] for stage in stages}
+    for entry in depends.split(';'):
+        stage, _, deps = entry.partition(':')
+        dependencies[stage] = [dep for dep in deps.split(',') if dep in stages]
+    return dependencies
+
+def run_stage(writer, stage, job_tags, fields, log_dir, stage_success):
+    print('starting', stage)
+    stage_tags = {**job_tags, 'stage': stage}
+    log_file = '{}/{}'.format(log_dir, stage)
+    stage_start_time = now()
+    writer.write('stage_duration', stage_tags, fields['running'])
+    stage_success = follow_file(writer, stage_tags, log_file,
+                                stage_success=stage_success)
+    if stage_success:
+        print(f'writing stage success for {stage}')
+        duration = {**fields['duration'],
+                    'value': ceil(now() - stage_start_time)}
+        writer.write('stage_duration', stage_tags, duration)
+    else:
+        print(f'writing stage failure for {stage}')
+        writer.write('stage_duration', stage_tags, fields['failure'])
+    writer.flush()
+    return stage_success
+
+def run_stages(writer, dependencies, job_tags, fields, log_dir):
+    writer.write('job_status', job_tags, fields['running'])
+
+    for stage in dependencies:
+        writer.write('stage_duration', {**job_tags, 'stage': stage},
+                     fields['pending'])
+    writer.flush()
+
+    cond = Condition()
+    results = {}
+
+    def follow_stage(stage, stage_success):
+        try:
+            stage_success = run_stage(writer, stage, job_tags, fields,
+                                      log_dir, stage_success)
+        finally:
+            with cond:
+                results[stage] = stage_success is True
+                cond.notify()
+
+    started = set()
+    with cond:
+        while len(results) < len(dependencies):
+            for stage, deps in dependencies.items():
+                if stage in started or not all(dep in results for dep in deps):
+                    continue
+                started.add(stage)
+                stage_success = False if not all(results[dep] for dep in deps) \
+                                else None
+                Thread(target=follow_stage, args=(stage, stage_success),
+                       daemon=True).start()
+            cond.wait()
+
+    if all(results.values()):
         print('job completed successfully')
-        status = format_metric('job_status', job_tags, fields['success'])
+        writer.write('job_status', job_tags, fields['success'])
     else:
         print('job ended with failure')
-        status = format_metric('job_status', job_tags, fields['failure'])
-    client.write_points(status)
+        writer.write('job_status', job_tags, fields['failure'])
 
 if __name__ == '__main__':
     args = docopt(__doc__)
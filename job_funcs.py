@@ -0,0 +1,161 @@
+from datetime import datetime, timedelta, timezone
+from kubernetes import watch
+from k8s_funcs import api_write
+from kubernetes.client.rest import ApiException
+from threading import Event, Lock
+from time import sleep
+
+def get_job_status(job):
+    status = job.status
+    if status.succeeded:
+        return 'success'
+    if status.failed:
+        return 'failure'
+    if status.active:
+        return 'running'
+    return 'pending'
+
+def get_finish_time(job):
+    status = job.status
+    if status.completion_time:
+        return status.completion_time
+    for condition in status.conditions or []:
+        if condition.type in ('Complete', 'Failed') and \
+                condition.status == 'True':
+            return condition.last_transition_time
+    return None
+
+class JobIndex:
+    def __init__(self, batch, namespace, selector='app=kubeline,type=job',
+                 on_change=None):
+        self.batch = batch
+        self.on_change = on_change
+        self.namespace = namespace
+        self.selector = selector
+        self.lock = Lock()
+        self.jobs = {}
+        self.resource_version = None
+        self.synced = Event()
+
+    def summarize(self, job):
+        labels = job.metadata.labels or {}
+        iteration = labels.get('iteration')
+        return {
+            'name': job.metadata.name,
+            'pipeline': labels.get('pipeline'),
+            'commit': labels.get('commit'),
+            'iteration': int(iteration) if iteration else None,
+            'status': get_job_status(job),
+            'created': job.metadata.creation_timestamp,
+            'finished': get_finish_time(job)
+        }
+
+    def sync(self):
+        resp = self.batch.list_namespaced_job(self.namespace,
+                                              label_selector=self.selector)
+        jobs = {job.metadata.name: self.summarize(job) for job in resp.items}
+        with self.lock:
+            self.jobs = jobs
+            self.resource_version = resp.metadata.resource_version
+        self.synced.set()
+        if self.on_change:
+            self.on_change()
+
+    def apply(self, event_type, job):
+        with self.lock:
+            if event_type == 'DELETED':
+                self.jobs.pop(job.metadata.name, None)
+            else:
+                self.jobs[job.metadata.name] = self.summarize(job)
+            self.resource_version = job.metadata.resource_version
+        if self.on_change:
+            self.on_change()
+
+    def watch(self, timeout=300):
+        stream = watch.Watch().stream(self.batch.list_namespaced_job,
+            self.namespace, label_selector=self.selector,
+            resource_version=self.resource_version, timeout_seconds=timeout)
+        for event in stream:
+            self.apply(event['type'], event['object'])
+
+    def run(self):
+        print(f'watching jobs in namespace {self.namespace}...')
+        while True:
+            try:
+                if self.resource_version is None:
+                    self.sync()
+                self.watch()
+            except ApiException as err:
+                if err.status == 410:
+                    self.resource_version = None
+                    continue
+                print(f'ERROR/watch: {err.status} {err.reason}')
+                sleep(5)
+            except Exception as err:
+                print(f'ERROR/watch: {err}, listing jobs again')
+                self.resource_version = None
+                sleep(5)
+
+    def track(self, job):
+        with self.lock:
+            self.jobs.setdefault(job.metadata.name, self.summarize(job))
+
+    def get_jobs(self, pipeline=None):
+        with self.lock:
+            jobs = [dict(job) for job in self.jobs.values()
+                    if pipeline is None or job['pipeline'] == pipeline]
+        epoch = datetime.min.replace(tzinfo=timezone.utc)
+        return sorted(jobs, key=lambda job: job['created'] or epoch,
+                      reverse=True)
+
+    def has_job(self, pipeline, commit):
+        with self.lock:
+            return any(job['pipeline'] == pipeline and job['commit'] == commit
+                       for job in self.jobs.values())
+
+    def count_active(self, pipeline=None):
+        with self.lock:
+            return len([job for job in self.jobs.values()
+                        if job['status'] in ('pending', 'running') and
+                        (pipeline is None or job['pipeline'] == pipeline)])
+
+    def get_expired(self, max_age, keep):
+        now = datetime.now(timezone.utc)
+        expired = []
+        kept = {}
+        for job in self.get_jobs():
+            if job['status'] in ('pending', 'running'):
+                continue
+            kept[job['pipeline']] = kept.get(job['pipeline'], 0) + 1
+            finished = job['finished'] or job['created']
+            if keep and kept[job['pipeline']] > keep:
+                expired.append(job['name'])
+            elif max_age and finished and \
+                    now - finished > timedelta(seconds=max_age):
+                expired.append(job['name'])
+        return expired
+
+    def supersede(self, pipeline, keep):
+        names = [job['name'] for job in self.get_jobs(pipeline)
+                 if job['status'] in ('pending', 'running') and
+                 job['name'] != keep]
+        return self.delete(names)
+
+    def reap(self, max_age, keep):
+        return self.delete(self.get_expired(max_age, keep))
+
+    def delete(self, names):
+        deleted = []
+        for name in names:
+            try:
+                api_write(self.batch.delete_namespaced_job, name,
+                    self.namespace, propagation_policy='Background')
+            except ApiException as err:
+                if err.status != 404:
+                    return deleted, f'deleting job {name}: {err.reason}'
+            with self.lock:
+                self.jobs.pop(name, None)
+            deleted.append(name)
+        if deleted and self.on_change:
+            self.on_change()
+        return deleted, None
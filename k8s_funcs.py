@@ -2,30 +2,98 @@ from jinja2 import Template, Environment, FileSystemLoader, StrictUndefined
 from jinja2.exceptions import UndefinedError
 from kubernetes import client, config
 from kubernetes.client.rest import ApiException
-from random import randint
+from metric_funcs import api_retries, job_create_time, render_time
+from queue_funcs import TokenBucket
+from random import randint, uniform
 from base64 import b64decode
 from os import environ, path, makedirs
+from threading import Lock
+from time import monotonic, sleep
 import yaml
 
-def Build(args, pipeline, config, commit, kubeline_yaml, namespace):
-    template_file = 'templates/job.jinja.yml'
-    env = Environment(loader=FileSystemLoader('.'), undefined=StrictUndefined)
-    template = env.get_template(template_file)
+template_file = 'templates/job.jinja.yml'
+template_env = Environment(loader=FileSystemLoader('.'),
+                           undefined=StrictUndefined, auto_reload=True)
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
 
+api = {'client': None, 'batch': None, 'core': None, 'coordination': None}
+api_lock = Lock()
+secrets = {'ttl': 60, 'cache': {}}
+secrets_lock = Lock()
+writes = {'bucket': TokenBucket(0), 'retries': 0, 'max_delay': 30}
+
+def init_api(secret_cache_ttl, write_rate=0, write_burst=1, retries=0):
+    secrets['ttl'] = secret_cache_ttl
+    writes['bucket'] = TokenBucket(write_rate, write_burst)
+    writes['retries'] = retries
+    get_api()
+
+def api_write(func, *args, retry_server_errors=True, **kwargs):
+    delay = 1
+    for attempt in range(writes['retries'] + 1):
+        writes['bucket'].acquire()
+        try:
+            return func(*args, **kwargs)
+        except ApiException as err:
+            server_error = retry_server_errors and (err.status or 0) >= 500
+            if err.status != 429 and not server_error or \
+                    attempt == writes['retries']:
+                raise
+            api_retries.labels(err.status).inc()
+            retry_after = (err.headers or {}).get('Retry-After', '')
+            if retry_after.isdigit():
+                wait = int(retry_after)
+            else:
+                wait = delay * uniform(1, 1.5)
+            wait = min(wait, writes['max_delay'])
+            print(f'WARNING/api: {err.status} {err.reason}, retrying in '
+                  f'{wait:.1f}s')
+            sleep(wait)
+            delay = min(delay * 2, writes['max_delay'])
+
+def get_api():
+    with api_lock:
+        if not api['client']:
+            load_config()
+            api['client'] = client.ApiClient()
+            api['batch'] = client.BatchV1Api(api['client'])
+            api['core'] = client.CoreV1Api(api['client'])
+            api['coordination'] = client.CoordinationV1Api(api['client'])
+    return api
+
+@render_time.time()
+def render_job(build_spec):
+    template = template_env.get_template(template_file)
+    return yaml.load(template.render(build_spec), Loader=yaml_loader)
+
+clone_modes = ['full', 'shallow', 'cached']
+workspace_media = ['Memory', 'disk']
+
+def Build(args, pipeline, config, commit, kubeline_yaml, namespace,
+          iteration=None):
+    clone_mode = config.get('clone_mode', 'full')
+    if clone_mode not in clone_modes:
+        return None, f'clone_mode {clone_mode} not valid'
+    workspace_medium = config.get('workspace_medium', 'Memory')
+    if workspace_medium not in workspace_media:
+        return None, f'workspace_medium {workspace_medium} not valid'
     build_spec = {
         'job_runner_image': args['--job-runner-image'],
         'pipeline': pipeline,
         'config': config,
         'commit': commit,
+        'iteration': iteration,
         'stages': kubeline_yaml['stages'],
+        'dependencies': format_dependencies(kubeline_yaml['stages']),
         'influxdb_host': args['--influxdb-host'],
         'influxdb_db': args['--influxdb-db'],
-        'git_key_secret': args['--git-key-secret']
+        'git_key_secret': args['--git-key-secret'],
+        'clone_mode': clone_mode,
+        'workspace_medium': workspace_medium,
+        'clone_cache_path': args['--clone-cache-path'],
+        'clone_cache_claim': args['--clone-cache-claim']
     }
-    body = template.render(build_spec)
-    body = yaml.load(body, Loader=yaml.FullLoader)
-    load_config()
-    batch = client.BatchV1Api()
+    body = render_job(build_spec)
     if 'docker_secret' in config:
         secret, err = get_secret(config['docker_secret'], namespace,
             secret_type='kubernetes.io/dockerconfigjson')
@@ -36,21 +104,39 @@ def Build(args, pipeline, config, commit, kubeline_yaml, namespace):
             secret_type='Opaque')
         if err:
             return None, err
-    resp = batch.create_namespaced_job(namespace, body)
+    try:
+        with job_create_time.time():
+            resp = api_write(get_api()['batch'].create_namespaced_job,
+                             namespace, body, retry_server_errors=False)
+    except ApiException as err:
+        return None, f'creating job: {err.status} {err.reason}'
     return resp, None
 
-def get_secret(name, namespace, secret_type=None):
-    load_config()
-    core = client.CoreV1Api()
+def read_secret(name, namespace):
+    key = (namespace, name)
+    with secrets_lock:
+        cached = secrets['cache'].get(key)
+    if cached and monotonic() - cached[0] < secrets['ttl']:
+        return cached[1], None
     try:
-        resp = core.read_namespaced_secret(name, namespace)
+        resp = get_api()['core'].read_namespaced_secret(name, namespace)
     except ApiException:
+        with secrets_lock:
+            secrets['cache'].pop(key, None)
         return None, f'could not locate secret {namespace}/{name}'
+    with secrets_lock:
+        secrets['cache'][key] = monotonic(), resp
+    return resp, None
+
+def get_secret(name, namespace, secret_type=None):
+    resp, err = read_secret(name, namespace)
+    if err:
+        return None, err
     if secret_type:
         if resp.type != secret_type:
             return None, f'secret {namespace}/{name} is not type {secret_type}'
     result = {}
-    for key, value in resp.data.items():
+    for key, value in (resp.data or {}).items():
         result[key] = b64decode(value).decode('utf-8')
     return result, None
 
@@ -104,8 +190,80 @@ def validate_pipeline_spec(kubeline_yaml):
             if type(stage['commands']) is not list:
                 err = msg + 'commands must be a list of commands'
                 return None, err
+    err = validate_dependencies(kubeline_yaml['stages'])
+    if err:
+        return None, err
     return kubeline_yaml, None
 
+def get_stage_dependencies(stages):
+    dependencies = {}
+    previous = []
+    for stage in stages:
+        dependencies[stage['name']] = stage.get('depends_on', previous)
+        previous = [stage['name']]
+    return dependencies
+
+def get_ancestors(dependencies, name):
+    ancestors = set()
+    pending = list(dependencies[name])
+    while pending:
+        dep = pending.pop()
+        if dep not in ancestors:
+            ancestors.add(dep)
+            pending.extend(dependencies[dep])
+    return ancestors
+
+def validate_dependencies(stages):
+    if not any('depends_on' in stage for stage in stages):
+        return None
+    names = [stage['name'] for stage in stages]
+    if len(set(names)) != len(names):
+        return 'stage names must be unique when using depends_on'
+    for stage in stages:
+        if 'depends_on' not in stage:
+            continue
+        msg = f'stage {stage["name"]} - '
+        if type(stage['depends_on']) is str:
+            stage['depends_on'] = [stage['depends_on']]
+        if type(stage['depends_on']) is not list:
+            return msg + 'depends_on must be a list of stage names'
+        for dep in stage['depends_on']:
+            if dep not in names:
+                return msg + f'depends_on unknown stage {dep}'
+
+    dependencies = get_stage_dependencies(stages)
+    remaining = {name: set(deps) for name, deps in dependencies.items()}
+    while remaining:
+        ready = [name for name, deps in remaining.items() if not deps]
+        if not ready:
+            return f'depends_on cycle between stages {", ".join(remaining)}'
+        for name in ready:
+            del remaining[name]
+        for deps in remaining.values():
+            deps.difference_update(ready)
+
+    for stage in stages:
+        if stage['type'] != 'docker-push':
+            continue
+        if stage['from_stage'] not in get_ancestors(dependencies, stage['name']):
+            return (f'stage {stage["name"]} - must depend on stage '
+                    f'{stage["from_stage"]}')
+    return None
+
+def format_dependencies(stages):
+    ids = {stage['name']: f'{idx}-{stage["name"]}'
+           for idx, stage in enumerate(stages, start=1)}
+    dependencies = []
+    previous = ['0-clone']
+    for idx, stage in enumerate(stages, start=1):
+        stage_id = f'{idx}-{stage["name"]}'
+        deps = previous
+        if 'depends_on' in stage:
+            deps = [ids[dep] for dep in stage['depends_on']] or ['0-clone']
+        dependencies.append(f'{stage_id}:{",".join(deps)}')
+        previous = [stage_id]
+    return ';'.join(dependencies)
+
 def get_namespace():
     namespace = None
     file_path = '/var/run/secrets/kubernetes.io/serviceaccount/namespace'
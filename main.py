@@ -6,6 +6,21 @@ Usage:
 
 Options:
   --check-frequency=<seconds>       how often kubeline will check git repos [default: 60]
+  --check-workers=<n>               number of git repos checked concurrently [default: 8]
+  --check-timeout=<seconds>         timeout for each git check [default: 30]
+  --http-check-ttl=<seconds>        how long https repo reachability is cached [default: 300]
+  --max-poll-backoff=<factor>       max factor by which idle or failing repos are polled less [default: 8]
+  --idle-after=<seconds>            time without new commits after which repos are polled less, 0 disables [default: 604800]
+  --dispatch-workers=<n>            number of builds dispatched concurrently [default: 4]
+  --max-running-jobs=<n>            max jobs running at once, 0 for no limit [default: 0]
+  --max-running-per-pipeline=<n>    max jobs of a pipeline running at once, 0 for no limit [default: 0]
+  --api-write-rate=<per second>     max k8s api writes per second, 0 for no limit [default: 5]
+  --api-write-burst=<n>             number of k8s api writes allowed in a burst [default: 10]
+  --api-retries=<n>                 retries of k8s api writes failing with 429 or 5xx [default: 5]
+  --sharding=<mode>                 share pipelines between replicas: off, lease or local [default: off]
+  --shard-id=<id>                   name of this replica, defaults to the hostname
+  --shard-dir=<dir>                 directory of replica heartbeats in local mode [default: tmp/shards]
+  --shard-lease-seconds=<seconds>   seconds after which a silent replica is dropped [default: 30]
   --config-file=<file>              config file to use [default: config.yml]
   --http-port=<port>                http port on which to listen [default: 8080]
   --namespace=<namespace>           namespace in which to run jobs
@@ -13,33 +28,76 @@ Options:
   --influxdb-db=<name>              name of the influxdb database to use [default: kubeline]
   --job-runner-image=<name>         image to pull for the job runner [default: j18e/job-runner:latest]
   --git-key-secret=<name>           k8s secret containing kubelines ssh key [default: kubeline-git-key]
+  --clone-cache-path=<path>         node path of the git cache for cached clones [default: /var/cache/kubeline/git]
+  --clone-cache-claim=<name>        pvc to use for the git cache instead of a node path
+  --secret-cache-ttl=<seconds>      how long k8s secret lookups are cached [default: 60]
+  --webhook-secret=<secret>         secret for /api/webhook, also read from KUBELINE_WEBHOOK_SECRET
+  --webhook-check-frequency=<seconds>  how often repos receiving webhooks are checked [default: 600]
+  --mirror-dir=<dir>                directory in which to cache git mirrors [default: tmp/mirrors]
+  --mirror-cache-size=<MB>          disk budget for cached git mirrors, 0 disables [default: 0]
+  --state-file=<file>               sqlite file in which to persist state [default: tmp/kubeline.db]
+  --spec-cache-size=<n>             number of pipeline specs to keep cached [default: 10000]
+  --commit-history=<n>              number of recent commits per pipeline to keep specs for [default: 20]
+  --seen-commits=<n>                number of older commits per pipeline to remember as built [default: 500]
+  --reap-after=<seconds>            delete finished jobs older than this, 0 disables [default: 0]
+  --keep-jobs=<n>                   finished jobs to keep per pipeline, 0 keeps all [default: 0]
+  --reap-frequency=<seconds>        how often finished jobs are reaped [default: 60]
   -h --help                         show this help text
 
 """
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from docopt import docopt
-from flask import Flask
-from git_funcs import get_pipeline_spec, get_commit, init_git_key
+from flask import Flask, Response, jsonify, request
+from git_funcs import (get_pipeline_spec, get_commit, get_refs, init_git_key,
+    init_http_check, init_mirror_cache)
 from hashlib import md5
-from k8s_funcs import Build, get_namespace
+from history_funcs import CommitHistory, get_spec_usage, init_history
+from job_funcs import JobIndex
+from k8s_funcs import Build, get_api, get_namespace, init_api
+from metric_funcs import (check_error, config_error, default_check_frequency,
+    history_commits, history_spec_bytes, history_specs, init_pipeline_metrics,
+    last_check, poll_cycle_time, poll_lag, queue_depth,
+    remove_pipeline_metrics, remove_repo_metrics, run_error,
+    superseded_builds)
+from os import _exit, environ, stat
+from requests import get as http_get
+from requests.exceptions import RequestException
+from shard_funcs import LeaseMembership, LocalMembership, Shard
+from signal import signal, SIGINT, SIGTERM
+from socket import gethostname
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from queue_funcs import (JobQueue, PollScheduler, PRIORITY_COMMIT,
+    PRIORITY_MANUAL)
+from store_funcs import init_store, next_iteration
+from webhook_funcs import normalize_url, parse_push, verify_signature
 from threading import Thread
-from time import sleep
+from time import sleep, monotonic
 import yaml
 
 app = Flask(__name__)
 
-now = lambda : int(datetime.now().timestamp())
-
 def check_config_file():
-    with open(args['--config-file'], 'rb') as stream:
-        checksum = md5(stream.read())
-    return checksum.hexdigest()
-
-def load_pipelines(pipelines=None):
-    global namespace
-    print('initializing pipeline state...')
+    global config_stat
+    global config_checksum
+    try:
+        file_stat = stat(args['--config-file'])
+        if config_stat == (file_stat.st_mtime_ns, file_stat.st_size):
+            return False
+        with open(args['--config-file'], 'rb') as stream:
+            checksum = md5(stream.read()).hexdigest()
+    except OSError as err:
+        if config_stat is None:
+            raise
+        print(f'ERROR/config: {err}, keeping previous pipeline state')
+        return False
+    config_stat = (file_stat.st_mtime_ns, file_stat.st_size)
+    if config_checksum == checksum:
+        return False
+    config_checksum = checksum
+    return True
 
+def read_config_file():
     with open(args['--config-file'], 'r') as stream:
         config_file = yaml.load(stream.read(), Loader=yaml.FullLoader)
     config_file = config_file['pipelines']
@@ -47,95 +105,423 @@ def load_pipelines(pipelines=None):
     for name in config_file:
         if 'branch' not in config_file[name]:
             config_file[name]['branch'] = 'master'
-    pipelines = {name: {'config': config_file[name],
-                 'commits': {}} for name in config_file}
+    return config_file
 
+def load_pipelines(pipelines=None):
+    global namespace
+    reload = pipelines is not None
+    if not reload:
+        print('initializing pipeline state...')
+        config_file = read_config_file()
+        pipelines = {}
+    else:
+        print('config file changed, updating pipeline state...')
+        try:
+            config_file = read_config_file()
+        except (OSError, yaml.YAMLError, KeyError, TypeError) as err:
+            print(f'ERROR/config: {err}, keeping previous pipeline state')
+            return pipelines
+
+    updated = {}
+    changed = {}
+    for name, config in config_file.items():
+        pipeline = pipelines.get(name)
+        if pipeline and pipeline['config'] == config:
+            updated[name] = pipeline
+            continue
+        if pipeline and (pipeline['config']['git_url'],
+                         pipeline['config']['branch']) == \
+                        (config['git_url'], config['branch']):
+            print(f'UPDATE {name}')
+            updated[name] = {**pipeline, 'config': config}
+            continue
+        if reload:
+            print(f'{"CHANGE" if pipeline else "NEW"} {name}')
+        if pipeline:
+            pipeline['commits'].clear()
+        updated[name] = {'config': config, 'commits': CommitHistory()}
+        if owns(name):
+            changed[name] = updated[name]
+        init_pipeline_metrics(name)
     for name in pipelines:
-        err = None
-        commit, err = get_commit(pipelines[name]['config'])
+        if name not in updated:
+            print(f'REMOVE {name}')
+            pipelines[name]['commits'].clear()
+            remove_pipeline_metrics(name)
+    repos = {normalize_url(pipeline['config']['git_url'])
+             for pipeline in updated.values()}
+    for pipeline in pipelines.values():
+        repo = normalize_url(pipeline['config']['git_url'])
+        if repo not in repos:
+            remove_repo_metrics(repo)
+
+    if shard and not reload:
+        take_over(changed)
+    else:
+        init_commits(changed)
+    print(f'pipeline state successfully {"updated" if reload else "initialized"}')
+    return updated
+
+def init_commits(pipelines):
+    timeout = int(args['--check-timeout'])
+    results = check_pipelines(pool, pipelines, timeout=timeout)
+    handled = {}
+    for name, (commit, pipeline_spec, err) in results.items():
         if err:
             print(f'ERROR/init {name}: {err}')
+        check_error.labels(name).set(not commit)
+        if commit:
+            last_check.labels(name).set_to_current_time()
+            config_error.labels(name).set(bool(err))
+            pipelines[name]['commits'][commit] = pipeline_spec
+            handled[name] = commit
+    record_commits(handled)
+
+def record_commits(commits):
+    global shard
+    if not shard:
+        return
+    try:
+        shard.record_commits(commits)
+    except Exception as err:
+        print(f'ERROR/shard: recording handled commits: {err}')
+
+def take_over(pipelines):
+    global shard
+    try:
+        handled = shard.get_commits()
+    except Exception as err:
+        print(f'ERROR/shard: getting handled commits: {err}, taking over '
+              f'pipelines at their latest commit')
+        handled = {}
+    for name, pipeline in pipelines.items():
+        if handled.get(name) and handled[name] not in pipeline['commits']:
+            pipeline['commits'][handled[name]] = None
+    init_commits({name: pipeline for name, pipeline in pipelines.items()
+                  if not len(pipeline['commits'])})
+
+def owns(name):
+    global shard
+    return not shard or shard.owns(name)
+
+def refresh_shard():
+    global shard
+    version = shard.version
+    try:
+        changed = shard.refresh()
+    except Exception as err:
+        print(f'ERROR/shard: {err}')
+        if shard.version != version:
+            print(f'WARNING/shard: membership not renewed for '
+                  f'{shard.membership.duration}s, giving up all pipelines')
+        return False
+    if changed:
+        owned = len([name for name in pipelines if owns(name)])
+        print(f'replicas {", ".join(shard.members)} sharing pipelines, '
+              f'{owned} of {len(pipelines)} owned by {shard.identity}')
+    return changed
+
+def shutdown(signum, frame):
+    global shard
+    if shard:
+        try:
+            shard.leave()
+        except Exception as err:
+            print(f'ERROR/shard: leaving: {err}')
+    print('exiting...')
+    _exit(0)
+
+def shard_heartbeat():
+    global shard
+    print(f'renewing shard membership every {shard_interval:.0f} seconds...')
+    while True:
+        sleep(shard_interval)
+        refresh_shard()
+
+def check_pipelines(pool, pipelines, timeout=None):
+    repos = {}
+    for name in pipelines:
+        url = pipelines[name]['config']['git_url']
+        repos.setdefault(url, []).append(name)
+    ref_futures = {pool.submit(get_refs, url, timeout=timeout): url
+                   for url in repos}
+    spec_futures = {}
+    checks = {}
+    for future in as_completed(ref_futures):
+        url = ref_futures[future]
+        refs, err = future.result()
+        for name in repos[url]:
+            if err:
+                checks[name] = None, None, err
+                continue
+            config = pipelines[name]['config']
+            commit, err = get_commit(config, refs=refs)
+            if err:
+                checks[name] = None, None, err
+                continue
+            if commit in pipelines[name]['commits']:
+                checks[name] = commit, None, None
+                continue
+            if (url, commit) not in spec_futures:
+                spec_futures[(url, commit)] = pool.submit(get_pipeline_spec,
+                    config, commit=commit, timeout=timeout)
+            checks[name] = commit, spec_futures[(url, commit)], None
+
+    results = {}
+    for name, (commit, spec_future, err) in checks.items():
+        pipeline_spec = None
+        if spec_future:
+            pipeline_spec, _, err = spec_future.result()
+        results[name] = commit, pipeline_spec, err
+    return results
+
+def get_poll_interval(pipeline):
+    interval = int(pipeline['config'].get('poll_interval',
+                                          args['--check-frequency']))
+    if 'webhook_time' in pipeline:
+        interval = max(interval, int(args['--webhook-check-frequency']))
+    return interval
+
+def poll_cycle(scheduler, now, timeout=None):
+    global pipelines
+    due = {name: lag for name, lag in scheduler.due(now, window=1)
+           if name in pipelines}
+    results = check_pipelines(pool, {name: pipelines[name] for name in due},
+                              timeout=timeout)
+    handled, queued = {}, []
+    for name, (commit, pipeline_spec, err) in results.items():
+        pipeline = pipelines[name]
+        pipeline['check_error'] = not commit
+        check_error.labels(name).set(not commit)
+        new_commit = commit and commit not in pipeline['commits']
+        scheduler.update(name, get_poll_interval(pipeline),
+                         changed=new_commit, failed=not commit)
+        if not commit:
+            print(f'ERROR/check {name}: {err}')
+            continue
+        last_check.labels(name).set_to_current_time()
+        if not new_commit:
             continue
-        pipelines[name]['commits'][commit] = None
-        pipeline_spec, _, err = get_pipeline_spec(pipelines[name]['config'],
-            commit=commit)
+        config_error.labels(name).set(bool(err))
+        handled[name] = commit
         if err:
-            print(f'ERROR/init {name}: {err}')
+            print(f'ERROR/check: pipeline spec in {name}: {err}')
             continue
-        pipelines[name]['commits'][commit] = pipeline_spec
-    print('pipeline state successfully initialized')
-    return pipelines
+        pipeline['commits'][commit] = pipeline_spec
+        queued.append(name)
+    record_commits(handled)
+    for name in queued:
+        print(f'ADD {name} to queue')
+        enqueue(name, handled[name])
+    return due
 
 def commit_updater():
     global args
     global pipelines
-    global config_checksum
     global queue
     global namespace
+    global pool
     check_frequency = int(args['--check-frequency'])
-    print(f'checking repos every {check_frequency} seconds...')
+    check_timeout = int(args['--check-timeout'])
+    scheduler = PollScheduler(max_backoff=float(args['--max-poll-backoff']),
+                              idle_after=int(args['--idle-after']))
+    for name in pipelines:
+        if owns(name):
+            scheduler.schedule(name, get_poll_interval(pipelines[name]))
+    print(f'checking repos every {check_frequency} seconds by default...')
 
+    report_time = monotonic()
+    shard_version = shard.version if shard else 0
+    checks, busy, max_lag = 0, 0, 0
     while True:
-        start_time = now()
-        if config_checksum != check_config_file():
-            pipelines = load_pipelines()
-            config_checksum = check_config_file()
-        for name in pipelines:
-            commit, err = get_commit(pipelines[name]['config'])
-            if err:
-                pipelines[name]['check_error'] = True
-                print(f'ERROR/check {name}: {err}')
-                continue
-            if commit in pipelines[name]['commits']:
-                continue
-            pipeline_spec, _, err = get_pipeline_spec(pipelines[name]['config'], commit=commit)
-            if err:
-                print(f'ERROR/check: pipeline spec in {name}')
-                continue
-            pipelines[name]['commits'][commit] = pipeline_spec
-            print(f'ADD {name} to queue')
-            queue.append((name, commit))
-        time_elapsed = start_time - now()
-        sleep(check_frequency - time_elapsed)
+        changed, handover = False, False
+        if check_config_file():
+            pipelines = load_pipelines(pipelines)
+            changed = True
+        if shard and shard.version != shard_version:
+            shard_version = shard.version
+            changed, handover = True, True
+        if changed:
+            for name in list(scheduler.deadlines):
+                if name not in pipelines or not owns(name):
+                    scheduler.remove(name)
+            acquired = {name: pipeline for name, pipeline in pipelines.items()
+                        if owns(name) and name not in scheduler.deadlines}
+            if handover:
+                take_over(acquired)
+            else:
+                init_commits({name: pipeline
+                              for name, pipeline in acquired.items()
+                              if not len(pipeline['commits'])})
+            for name, pipeline in acquired.items():
+                scheduler.schedule(name,
+                    0 if handover else get_poll_interval(pipeline))
 
-def queue_watcher():
+        start_time = monotonic()
+        due = poll_cycle(scheduler, start_time, timeout=check_timeout)
+        if due:
+            elapsed = monotonic() - start_time
+            poll_cycle_time.observe(elapsed)
+            poll_lag.set(max(due.values()))
+            checks += len(due)
+            busy += elapsed
+            max_lag = max(max_lag, *due.values())
+
+        if monotonic() - report_time >= check_frequency:
+            print(f'checked {checks} pipelines in {busy:.2f}s over the last '
+                  f'{check_frequency}s, at most {max_lag:.2f}s behind schedule')
+            if max_lag > check_frequency:
+                print(f'WARNING/check: checks are running {max_lag:.2f}s '
+                      f'behind schedule, consider raising --check-workers')
+            report_history()
+            report_time = monotonic()
+            checks, busy, max_lag = 0, 0, 0
+
+        next_deadline = scheduler.next_deadline() or monotonic() + 5
+        sleep(min(max(next_deadline - monotonic(), 0), 5))
+
+def report_history():
+    recent, seen = 0, 0
+    for pipeline in list(pipelines.values()):
+        recent += len(pipeline['commits'])
+        seen += pipeline['commits'].seen_count()
+    spec_count, spec_bytes = get_spec_usage()
+    history_commits.labels('recent').set(recent)
+    history_commits.labels('seen').set(seen)
+    history_specs.set(spec_count)
+    history_spec_bytes.set(spec_bytes)
+    print(f'commit history: {recent} recent and {seen} seen commits, '
+          f'{spec_count} distinct specs using ~{spec_bytes // 1024}KB')
+
+def enqueue(name, commit, priority=PRIORITY_COMMIT):
+    global queue
+    queue.put(name, commit, priority=priority)
+    if not pipelines[name]['config'].get('supersede'):
+        return
+    for old_commit in queue.supersede(name, commit):
+        superseded_builds.labels('queued').inc()
+        print(f'SUPERSEDED {name} at {old_commit or "latest"} in queue')
+
+def admit(name, dispatching):
+    global job_index
+    max_running = int(args['--max-running-jobs'])
+    max_pipeline = 0
+    pipeline = pipelines.get(name)
+    if pipeline and not pipeline['config'].get('supersede'):
+        max_pipeline = int(pipeline['config'].get('max_running',
+            args['--max-running-per-pipeline']))
+    if not max_running and not max_pipeline:
+        return True
+    if not job_index.synced.is_set():
+        return False
+    if max_running and job_index.count_active() + dispatching >= max_running:
+        return False
+    return not max_pipeline or job_index.count_active(name) < max_pipeline
+
+def get_last_iteration(name):
+    pipeline = name.replace("'", "\\'")
+    query = f'select last("value"),iteration from "job_status" where ' \
+            f'"pipeline" = \'{pipeline}\''
+    try:
+        resp = http_get(f'http://{args["--influxdb-host"]}:8086/query',
+                        params={'db': args['--influxdb-db'], 'q': query},
+                        timeout=10)
+        resp.raise_for_status()
+        series = resp.json()['results'][0].get('series')
+    except (RequestException, ValueError, KeyError, IndexError) as err:
+        print(f'WARNING/iteration: could not get last iteration of {name} '
+              f'from influxdb: {err}')
+        return None
+    if not series:
+        return 0
+    columns = series[0]['columns']
+    iteration = series[0]['values'][0][columns.index('iteration')]
+    return int(iteration) if iteration else 0
+
+def allocate_iteration(name):
+    global shard
+    if shard:
+        return shard.next_iteration(name, seed=get_last_iteration)
+    return next_iteration(name, seed=get_last_iteration)
+
+def dispatch(name, commit, skip_built=False):
     global args
     global pipelines
-    global queue
     global namespace
-    print('starting queue watcher...')
+    global job_index
+    pipeline = pipelines.get(name)
+    if not pipeline:
+        print(f'ERROR/trigger {name}: pipeline no longer configured')
+        return
+    if not commit:
+        commit, err = get_commit(pipeline['config'])
+        if err:
+            pipeline['check_error'] = True
+            check_error.labels(name).set(1)
+            print(f'ERROR getting commit for {name}: {err}')
+            return
+    if skip_built and not job_index.synced.wait(timeout=30):
+        print(f'WARNING/trigger {name}: jobs not listed yet, building '
+              f'{commit} without checking for an existing job')
+    elif skip_built and job_index.has_job(name, commit):
+        print(f'SKIP {name} at {commit}: already built')
+        return
+    pipeline_spec = pipeline['commits'].get(commit)
+    if not pipeline_spec:
+        pipeline_spec, _, err = get_pipeline_spec(pipeline['config'], commit=commit)
+        pipeline['commits'][commit] = pipeline_spec
+        config_error.labels(name).set(bool(err))
+        if err:
+            print(f'ERROR/trigger {name} at {commit}: {err}')
+            return
+    resp, err = Build(args, name, pipeline['config'],
+        commit, pipeline_spec, namespace,
+        iteration=allocate_iteration(name))
+    run_error.labels(name).set(bool(err))
+    if err:
+        print(f'ERROR/trigger {name}: {err}')
+        return
+    job_index.track(resp)
+    print(f'TRIGGERED {name} at {commit}')
+    if not pipeline['config'].get('supersede'):
+        return
+    superseded, err = job_index.supersede(name, resp.metadata.name)
+    for job_name in superseded:
+        superseded_builds.labels('running').inc()
+        print(f'SUPERSEDED {name} job {job_name}')
+    if err:
+        print(f'ERROR/supersede {name}: {err}')
 
+def reaper():
+    global job_index
+    max_age = int(args['--reap-after'])
+    keep = int(args['--keep-jobs'])
+    if not max_age and not keep:
+        return
+    print('starting job reaper...')
+    job_index.synced.wait()
     while True:
-        if not queue:
-            sleep(1)
-            continue
-        job = queue.pop()
-        name = job[0]
-        commit = job[1]
-        pipeline = pipelines[name]
-        if not commit:
-            commit, err = get_commit(pipeline['config'])
-            if err:
-                pipelines[name]['check_error'] = True
-                print(f'ERROR getting commit for {name}: {err}')
-                continue
-        if commit in pipeline['commits']:
-            pipeline_spec = pipeline['commits'][commit]
-            if not pipeline_spec:
-                print(f'ERROR/trigger {name} at {commit}: no pipeline spec')
-                continue
-        else:
-            pipeline_spec, _, err = get_pipeline_spec(pipelines[name]['config'], commit=commit)
-            pipelines[name][commit] = pipeline_spec
-            if err:
-                print(f'ERROR/trigger {name} at {commit}: {err}')
-                continue
-        resp, err = Build(args, name, pipeline['config'],
-            commit, pipeline_spec, namespace)
+        deleted, err = job_index.reap(max_age, keep)
+        if deleted:
+            print(f'REAPED {len(deleted)} finished jobs')
         if err:
+            print(f'ERROR/reap: {err}')
+        sleep(int(args['--reap-frequency']))
+
+def queue_watcher():
+    global queue
+    print('starting queue watcher...')
+
+    while True:
+        name, commit, priority = queue.get()
+        try:
+            dispatch(name, commit, skip_built=shard is not None and
+                     priority != PRIORITY_MANUAL)
+        except Exception as err:
+            run_error.labels(name).set(1)
             print(f'ERROR/trigger {name}: {err}')
-            continue
-        print(f'TRIGGERED {name} at {commit}')
+        finally:
+            queue.done(name)
 
 @app.errorhandler(404)
 def not_found(error):
@@ -145,6 +531,22 @@ def not_found(error):
 def not_found(error):
     return '500 internal server error\n', 500
 
+@app.route('/metrics')
+def metrics():
+    return Response(generate_latest(), content_type=CONTENT_TYPE_LATEST)
+
+@app.route('/api/status/<pipeline>')
+def pipeline_status(pipeline):
+    global job_index
+    if pipeline not in pipelines:
+        return f'ERROR pipeline "{pipeline}" not found\n', 404
+    jobs = []
+    for job in job_index.get_jobs(pipeline):
+        for field in ['created', 'finished']:
+            job[field] = job[field] and job[field].isoformat()
+        jobs.append(job)
+    return jsonify({'pipeline': pipeline, 'jobs': jobs})
+
 @app.route('/api/run/<pipeline>', methods=['POST', 'GET'])
 def trigger_build(pipeline):
     global queue
@@ -155,22 +557,88 @@ def trigger_build(pipeline):
     if pipelines[pipeline].get('check_error') is True:
         msg = f'ERROR git check error in {pipeline}'
         return msg, 500
-    queue.append((pipeline, None))
+    enqueue(pipeline, None, priority=PRIORITY_MANUAL)
     return f'{pipeline} added to queue'
 
+@app.route('/api/webhook', methods=['POST'])
+def trigger_webhook():
+    global queue
+    global pipelines
+    secret = args['--webhook-secret'] or environ.get('KUBELINE_WEBHOOK_SECRET')
+    if not secret:
+        return '404 not found\n', 404
+    body = request.get_data()
+    if not verify_signature(request.headers, body, secret):
+        return 'ERROR invalid webhook signature\n', 403
+    urls, branch, commit, err = parse_push(request.headers, body)
+    if err:
+        return f'ERROR {err}\n', 400
+    if not commit:
+        return 'nothing to do\n'
+    matched = []
+    for name, pipeline in pipelines.items():
+        config = pipeline['config']
+        if config['branch'] != branch or \
+                normalize_url(config['git_url']) not in urls:
+            continue
+        pipeline['webhook_time'] = monotonic()
+        if commit in pipeline['commits']:
+            continue
+        pipeline['commits'][commit] = None
+        print(f'ADD {name} to queue from webhook')
+        enqueue(name, commit, priority=PRIORITY_MANUAL)
+        matched.append(name)
+    return f'{len(matched)} pipelines added to queue\n'
+
 if __name__ == '__main__':
     args = docopt(__doc__)
     namespace = args['--namespace'] or get_namespace() or 'default'
+    init_api(int(args['--secret-cache-ttl']),
+             write_rate=float(args['--api-write-rate']),
+             write_burst=int(args['--api-write-burst']),
+             retries=int(args['--api-retries']))
     _, err = init_git_key(args['--git-key-secret'], namespace)
     if err:
         print(f'ERROR/ssh: {err}. Exiting...')
         exit()
+    init_http_check(int(args['--http-check-ttl']))
+    init_mirror_cache(args['--mirror-dir'], int(args['--mirror-cache-size']))
+    init_store(args['--state-file'], int(args['--spec-cache-size']))
+    init_history(int(args['--commit-history']), int(args['--seen-commits']))
+    pool = ThreadPoolExecutor(max_workers=int(args['--check-workers']))
+    shard = None
+    shard_interval = int(args['--shard-lease-seconds']) / 3
+    shard_id = args['--shard-id'] or environ.get('HOSTNAME') or gethostname()
+    if args['--sharding'] == 'lease':
+        shard = Shard(LeaseMembership(get_api()['coordination'],
+            get_api()['core'], namespace, shard_id,
+            duration=int(args['--shard-lease-seconds'])))
+    elif args['--sharding'] == 'local':
+        shard = Shard(LocalMembership(args['--shard-dir'], shard_id,
+            duration=int(args['--shard-lease-seconds'])))
+    elif args['--sharding'] != 'off':
+        print(f'ERROR/shard: unknown mode {args["--sharding"]}. Exiting...')
+        exit()
+    if shard:
+        refresh_shard()
+    signal(SIGTERM, shutdown)
+    signal(SIGINT, shutdown)
+    config_stat = None
+    config_checksum = None
+    check_config_file()
     pipelines = load_pipelines()
-    config_checksum = check_config_file()
-    queue = []
+    queue = JobQueue(admit=admit)
+    queue_depth.set_function(lambda: len(queue))
+    default_check_frequency.set(int(args['--check-frequency']))
+    job_index = JobIndex(get_api()['batch'], namespace, on_change=queue.wake)
+    Thread(target=job_index.run, daemon=True).start()
+    Thread(target=reaper, daemon=True).start()
     commit_updater_thread = Thread(target=commit_updater)
     commit_updater_thread.start()
-    queue_watcher_thread = Thread(target=queue_watcher)
-    queue_watcher_thread.start()
+    if shard:
+        Thread(target=shard_heartbeat, daemon=True).start()
+    for _ in range(int(args['--dispatch-workers'])):
+        queue_watcher_thread = Thread(target=queue_watcher)
+        queue_watcher_thread.start()
     app.run(host='0.0.0.0', port=int(args['--http-port']))
 
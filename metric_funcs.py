@@ -0,0 +1,64 @@
+from prometheus_client import Counter, Gauge, Histogram
+
+git_buckets = (.05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+api_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5)
+
+ls_remote_time = Histogram('kubeline_ls_remote_seconds',
+    'time taken listing the branches of a git repo', ['repo'],
+    buckets=git_buckets)
+spec_fetch_time = Histogram('kubeline_pipeline_spec_seconds',
+    'time taken getting a pipeline spec, including cache hits',
+    buckets=git_buckets)
+clone_time = Histogram('kubeline_clone_seconds',
+    'time taken by full clones of a git repo', buckets=git_buckets)
+render_time = Histogram('kubeline_render_seconds',
+    'time taken rendering a job manifest', buckets=api_buckets)
+job_create_time = Histogram('kubeline_job_create_seconds',
+    'time taken by the k8s api to create a job', buckets=api_buckets)
+poll_cycle_time = Histogram('kubeline_poll_cycle_seconds',
+    'time taken checking the pipelines due in one poll cycle',
+    buckets=git_buckets)
+
+queue_depth = Gauge('kubeline_queue_depth', 'number of builds waiting in queue')
+poll_lag = Gauge('kubeline_poll_lag_seconds',
+    'how far behind schedule the most recent poll cycle ran')
+default_check_frequency = Gauge('kubeline_check_frequency_seconds',
+    'default seconds between checks of a git repo')
+last_check = Gauge('kubeline_last_check_timestamp_seconds',
+    'time of the last successful git check of a pipeline', ['pipeline'])
+check_error = Gauge('kubeline_check_error',
+    'whether the last git check of a pipeline failed', ['pipeline'])
+config_error = Gauge('kubeline_config_error',
+    'whether the pipeline spec at the latest commit is invalid', ['pipeline'])
+run_error = Gauge('kubeline_run_error',
+    'whether the last attempt to start a build failed', ['pipeline'])
+api_retries = Counter('kubeline_api_retries',
+    'k8s api writes retried after a throttling or server error', ['status'])
+superseded_builds = Counter('kubeline_superseded_builds',
+    'builds replaced by a newer commit of the same pipeline', ['state'])
+history_commits = Gauge('kubeline_history_commits',
+    'commits remembered across all pipelines', ['kind'])
+history_specs = Gauge('kubeline_history_specs',
+    'distinct pipeline specs held in memory')
+history_spec_bytes = Gauge('kubeline_history_spec_bytes',
+    'approximate size of the pipeline specs held in memory, serialized')
+
+pipeline_gauges = [last_check, check_error, config_error, run_error]
+
+def init_pipeline_metrics(name):
+    for gauge in pipeline_gauges:
+        if gauge is not last_check:
+            gauge.labels(name).set(0)
+
+def remove_pipeline_metrics(name):
+    for gauge in pipeline_gauges:
+        try:
+            gauge.remove(name)
+        except KeyError:
+            pass
+
+def remove_repo_metrics(repo):
+    try:
+        ls_remote_time.remove(repo)
+    except KeyError:
+        pass
@@ -0,0 +1,164 @@
+from heapq import heappush, heappop
+from itertools import count
+from random import uniform
+from threading import Condition, Lock
+from time import monotonic, sleep
+
+PRIORITY_MANUAL = 0
+PRIORITY_COMMIT = 1
+
+class JobQueue:
+    def __init__(self, admit=None):
+        self.admit = admit
+        self.cond = Condition()
+        self.heap = []
+        self.entries = {}
+        self.active = set()
+        self.counter = count()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.entries)
+
+    def put(self, pipeline, commit, priority=PRIORITY_COMMIT):
+        key = (pipeline, commit)
+        with self.cond:
+            entry = self.entries.get(key)
+            if entry:
+                if entry[0] <= priority:
+                    return False
+                entry[2] = None
+            entry = [priority, next(self.counter), key]
+            self.entries[key] = entry
+            heappush(self.heap, entry)
+            self.cond.notify()
+        return True
+
+    def supersede(self, pipeline, keep):
+        superseded = []
+        with self.cond:
+            for key, entry in list(self.entries.items()):
+                if key[0] == pipeline and key[1] != keep:
+                    entry[2] = None
+                    del self.entries[key]
+                    superseded.append(key[1])
+        return superseded
+
+    def get(self):
+        with self.cond:
+            while True:
+                entry = self.pop_ready()
+                if entry:
+                    break
+                self.cond.wait()
+            pipeline, commit = entry[2]
+            del self.entries[(pipeline, commit)]
+            self.active.add(pipeline)
+        return pipeline, commit, entry[0]
+
+    def pop_ready(self):
+        skipped = []
+        ready = None
+        while self.heap:
+            entry = heappop(self.heap)
+            if entry[2] is None:
+                continue
+            if entry[2][0] in self.active or (self.admit and
+                    not self.admit(entry[2][0], len(self.active))):
+                skipped.append(entry)
+                continue
+            ready = entry
+            break
+        for entry in skipped:
+            heappush(self.heap, entry)
+        return ready
+
+    def done(self, pipeline):
+        with self.cond:
+            self.active.discard(pipeline)
+            self.cond.notify_all()
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.tokens = self.burst
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = monotonic()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, 0)
+        sleep(wait)
+        return wait
+
+class PollScheduler:
+    def __init__(self, max_backoff=8, jitter=0.1, idle_after=604800):
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.idle_after = idle_after
+        self.heap = []
+        self.deadlines = {}
+        self.changed_at = {}
+        self.errors = {}
+        self.counter = count()
+
+    def __len__(self):
+        return len(self.deadlines)
+
+    def schedule(self, name, interval):
+        interval *= uniform(1 - self.jitter, 1 + self.jitter)
+        deadline = monotonic() + max(interval, 1)
+        self.deadlines[name] = deadline
+        self.changed_at.setdefault(name, monotonic())
+        heappush(self.heap, (deadline, next(self.counter), name))
+
+    def remove(self, name):
+        self.deadlines.pop(name, None)
+        self.changed_at.pop(name, None)
+        self.errors.pop(name, None)
+
+    def next_deadline(self):
+        while self.heap:
+            deadline, _, name = self.heap[0]
+            if self.deadlines.get(name) == deadline:
+                return deadline
+            heappop(self.heap)
+        return None
+
+    def due(self, now, window=0):
+        names = []
+        while self.next_deadline() is not None and \
+                self.heap[0][0] <= now + window:
+            deadline, _, name = heappop(self.heap)
+            del self.deadlines[name]
+            names.append((name, now - deadline))
+        return names
+
+    def update(self, name, interval, changed=False, failed=False):
+        if failed:
+            self.errors[name] = self.errors.get(name, 0) + 1
+            factor = min(2 ** self.errors[name], self.max_backoff)
+        elif changed:
+            self.errors.pop(name, None)
+            self.changed_at[name] = monotonic()
+            factor = 0.5
+        else:
+            self.errors.pop(name, None)
+            factor = 1
+            if self.idle_after:
+                idle = monotonic() - self.changed_at.get(name, monotonic())
+                factor = min(max(idle / self.idle_after, 1), self.max_backoff)
+        self.schedule(name, interval * factor)
+        return interval * factor
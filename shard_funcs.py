@@ -0,0 +1,285 @@
+from bisect import bisect
+from datetime import datetime, timedelta, timezone
+from hashlib import md5
+from kubernetes import client
+from kubernetes.client.rest import ApiException
+from os import listdir, makedirs, remove, utime
+import os.path
+from time import monotonic, time
+import sqlite3
+
+def get_hash(key):
+    return int(md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+class HashRing:
+    def __init__(self, members, replicas=64):
+        points = sorted((get_hash(f'{member}-{idx}'), member)
+                        for member in members for idx in range(replicas))
+        self.hashes = [point[0] for point in points]
+        self.members = [point[1] for point in points]
+
+    def owner(self, key):
+        if not self.members:
+            return None
+        idx = bisect(self.hashes, get_hash(key)) % len(self.hashes)
+        return self.members[idx]
+
+class LeaseMembership:
+    def __init__(self, coordination, core, namespace, identity, duration=30):
+        self.api = coordination
+        self.core = core
+        self.namespace = namespace
+        self.identity = identity
+        self.duration = duration
+        self.name = f'kubeline-shard-{identity}'
+        self.timeout = duration / 3
+        self.selector = 'app=kubeline,type=shard'
+
+    def heartbeat(self):
+        body = client.V1Lease(
+            metadata=client.V1ObjectMeta(name=self.name,
+                labels={'app': 'kubeline', 'type': 'shard'}),
+            spec=client.V1LeaseSpec(holder_identity=self.identity,
+                lease_duration_seconds=self.duration,
+                renew_time=datetime.now(timezone.utc)))
+        try:
+            self.api.replace_namespaced_lease(self.name, self.namespace, body,
+                                              _request_timeout=self.timeout)
+        except ApiException as err:
+            if err.status != 404:
+                raise
+            self.api.create_namespaced_lease(self.namespace, body,
+                                             _request_timeout=self.timeout)
+
+    def members(self):
+        leases = self.api.list_namespaced_lease(self.namespace,
+            label_selector=self.selector, _request_timeout=self.timeout)
+        now = datetime.now(timezone.utc)
+        members = []
+        for lease in leases.items:
+            spec = lease.spec
+            if not spec.holder_identity or not spec.renew_time:
+                continue
+            duration = timedelta(seconds=spec.lease_duration_seconds or
+                                 self.duration)
+            if spec.renew_time + duration > now:
+                members.append(spec.holder_identity)
+            elif spec.renew_time + 2 * duration < now:
+                try:
+                    self.delete(lease.metadata.name,
+                                lease.metadata.resource_version)
+                except ApiException:
+                    pass
+        return sorted(members)
+
+    def delete(self, name, resource_version=None):
+        options = client.V1DeleteOptions(preconditions=client.V1Preconditions(
+            resource_version=resource_version)) if resource_version else None
+        try:
+            self.api.delete_namespaced_lease(name, self.namespace,
+                body=options, _request_timeout=self.timeout)
+        except ApiException as err:
+            if err.status not in (404, 409):
+                raise
+
+    def leave(self):
+        self.delete(self.name)
+
+    def update_config_map(self, name, update):
+        while True:
+            try:
+                config_map = self.core.read_namespaced_config_map(name,
+                    self.namespace, _request_timeout=self.timeout)
+            except ApiException as err:
+                if err.status != 404:
+                    raise
+                config_map = client.V1ConfigMap(
+                    metadata=client.V1ObjectMeta(name=name,
+                        labels={'app': 'kubeline', 'type': 'state'}))
+            data = dict(config_map.data or {})
+            result = update(data)
+            if result is None:
+                return None
+            config_map.data = data
+            try:
+                if config_map.metadata.resource_version:
+                    self.core.replace_namespaced_config_map(name,
+                        self.namespace, config_map,
+                        _request_timeout=self.timeout)
+                else:
+                    self.core.create_namespaced_config_map(self.namespace,
+                        config_map, _request_timeout=self.timeout)
+            except ApiException as err:
+                if err.status != 409:
+                    raise
+                continue
+            return result
+
+    def next_iteration(self, pipeline, seed):
+        seeded = []
+
+        def increment(data):
+            if pipeline in data:
+                last = int(data[pipeline])
+            else:
+                if not seeded:
+                    seeded.append(seed(pipeline))
+                last = seeded[0]
+                if last is None:
+                    return None
+            data[pipeline] = str(last + 1)
+            return last + 1
+
+        return self.update_config_map('kubeline-iterations', increment)
+
+    def get_commits(self):
+        try:
+            config_map = self.core.read_namespaced_config_map(
+                'kubeline-commits', self.namespace,
+                _request_timeout=self.timeout)
+        except ApiException as err:
+            if err.status != 404:
+                raise
+            return {}
+        return config_map.data or {}
+
+    def record_commits(self, commits):
+        def record(data):
+            if all(data.get(name) == commit
+                   for name, commit in commits.items()):
+                return None
+            data.update(commits)
+            return True
+
+        self.update_config_map('kubeline-commits', record)
+
+class LocalMembership:
+    def __init__(self, directory, identity, duration=30):
+        self.directory = directory
+        self.identity = identity
+        self.duration = duration
+        self.path = os.path.join(directory, identity)
+        self.state = os.path.join(directory, '.shared.db')
+
+    def heartbeat(self):
+        if not os.path.exists(self.directory):
+            makedirs(self.directory)
+        with open(self.path, 'a'):
+            utime(self.path)
+
+    def members(self):
+        now = time()
+        members = []
+        for name in listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                mtime = os.path.getmtime(path)
+                if mtime + self.duration > now:
+                    members.append(name)
+                elif mtime + 2 * self.duration < now:
+                    remove(path)
+            except OSError:
+                continue
+        return sorted(members)
+
+    def leave(self):
+        try:
+            remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def connect(self):
+        conn = sqlite3.connect(self.state, timeout=30, isolation_level=None)
+        conn.execute('create table if not exists iterations '
+                     '(pipeline text primary key, iteration integer not null)')
+        conn.execute('create table if not exists commits '
+                     '(pipeline text primary key, git_commit text not null)')
+        return conn
+
+    def next_iteration(self, pipeline, seed):
+        conn = self.connect()
+        try:
+            row = conn.execute('select iteration from iterations '
+                               'where pipeline = ?', (pipeline,)).fetchone()
+            if not row:
+                last = seed(pipeline)
+                if last is None:
+                    return None
+                conn.execute('insert or ignore into iterations '
+                             '(pipeline, iteration) values (?, ?)',
+                             (pipeline, last))
+            conn.execute('begin immediate')
+            conn.execute('update iterations set iteration = iteration + 1 '
+                         'where pipeline = ?', (pipeline,))
+            row = conn.execute('select iteration from iterations '
+                               'where pipeline = ?', (pipeline,)).fetchone()
+            conn.execute('commit')
+        finally:
+            conn.close()
+        return row[0]
+
+    def get_commits(self):
+        conn = self.connect()
+        try:
+            return dict(conn.execute('select pipeline, git_commit '
+                                     'from commits').fetchall())
+        finally:
+            conn.close()
+
+    def record_commits(self, commits):
+        conn = self.connect()
+        try:
+            conn.executemany('insert or replace into commits '
+                             '(pipeline, git_commit) values (?, ?)',
+                             commits.items())
+        finally:
+            conn.close()
+
+class Shard:
+    def __init__(self, membership, replicas=64):
+        self.membership = membership
+        self.identity = membership.identity
+        self.replicas = replicas
+        self.members = []
+        self.version = 0
+        self.renewed = monotonic()
+        self.ring = HashRing([self.identity], replicas)
+
+    def refresh(self):
+        try:
+            self.membership.heartbeat()
+            members = self.membership.members()
+        except Exception:
+            if self.ring.members and \
+                    monotonic() - self.renewed > self.membership.duration:
+                self.members = []
+                self.ring = HashRing([], self.replicas)
+                self.version += 1
+            raise
+        self.renewed = monotonic()
+        if self.identity not in members:
+            members = sorted(members + [self.identity])
+        if members == self.members:
+            return False
+        self.members = members
+        self.ring = HashRing(members, self.replicas)
+        self.version += 1
+        return True
+
+    def owns(self, name):
+        return self.ring.owner(name) == self.identity
+
+    def leave(self):
+        self.membership.leave()
+
+    def next_iteration(self, pipeline, seed):
+        return self.membership.next_iteration(pipeline, seed)
+
+    def get_commits(self):
+        return self.membership.get_commits()
+
+    def record_commits(self, commits):
+        if commits:
+            self.membership.record_commits(commits)
@@ -0,0 +1,77 @@
+from os import makedirs
+import os.path
+from threading import Lock
+from time import time
+import sqlite3
+
+store = {'conn': None, 'max_specs': 0}
+store_lock = Lock()
+
+def init_store(path, max_specs):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        makedirs(directory)
+    conn = sqlite3.connect(path, check_same_thread=False)
+    with conn:
+        conn.execute('drop table if exists specs')
+        conn.execute('''create table if not exists spec_files (
+            git_url text not null,
+            git_commit text not null,
+            contents text,
+            last_used real not null,
+            primary key (git_url, git_commit))''')
+        conn.execute('create index if not exists spec_files_last_used '
+                     'on spec_files (last_used)')
+        conn.execute('''create table if not exists iterations (
+            pipeline text primary key,
+            iteration integer not null)''')
+    store['conn'] = conn
+    store['max_specs'] = max_specs
+    count = conn.execute('select count(*) from spec_files').fetchone()[0]
+    print(f'using state file {path}, {count} pipeline specs cached')
+
+def get_cached_file(url, commit):
+    if not store['conn']:
+        return False, None
+    with store_lock, store['conn'] as conn:
+        row = conn.execute('select contents from spec_files '
+                           'where git_url = ? and git_commit = ?',
+                           (url, commit)).fetchone()
+        if not row:
+            return False, None
+        conn.execute('update spec_files set last_used = ? '
+                     'where git_url = ? and git_commit = ?',
+                     (time(), url, commit))
+    return True, row[0]
+
+def cache_file(url, commit, contents):
+    if not store['conn']:
+        return
+    with store_lock, store['conn'] as conn:
+        conn.execute('insert or replace into spec_files '
+                     '(git_url, git_commit, contents, last_used) '
+                     'values (?, ?, ?, ?)', (url, commit, contents, time()))
+        conn.execute('delete from spec_files where rowid not in (select rowid '
+                     'from spec_files order by last_used desc limit ?)',
+                     (store['max_specs'],))
+
+def next_iteration(pipeline, seed=None):
+    if seed:
+        with store_lock, store['conn'] as conn:
+            row = conn.execute('select iteration from iterations '
+                               'where pipeline = ?', (pipeline,)).fetchone()
+        if not row:
+            last = seed(pipeline)
+            if last is None:
+                return None
+            with store_lock, store['conn'] as conn:
+                conn.execute('insert or ignore into iterations '
+                             '(pipeline, iteration) values (?, ?)',
+                             (pipeline, last))
+    with store_lock, store['conn'] as conn:
+        conn.execute('insert into iterations (pipeline, iteration) '
+                     'values (?, 1) on conflict (pipeline) '
+                     'do update set iteration = iteration + 1', (pipeline,))
+        row = conn.execute('select iteration from iterations '
+                           'where pipeline = ?', (pipeline,)).fetchone()
+    return row[0]
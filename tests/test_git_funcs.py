@@ -0,0 +1,47 @@
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from git_funcs import get_pipeline_spec
+from store_funcs import cache_file, init_store, store
+
+config = {'git_url': 'https://git.invalid/j18e/kubeline', 'branch': 'master'}
+commit = 'c0ffee' * 6 + 'c0ff'
+
+class CachedSpecTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+        init_store(join(self.tmp.name, 'kubeline.db'), 10)
+
+    def tearDown(self):
+        store['conn'].close()
+        store['conn'] = None
+        self.tmp.cleanup()
+
+    def test_cached_spec_is_validated(self):
+        cache_file(config['git_url'], commit,
+                   'stages:\n- name: test\n  type: custom\n'
+                   '  image: alpine:3.9\n  commands: [make test]\n'
+                   '  depends_on: [test]\n')
+        spec, found, err = get_pipeline_spec(config, commit=commit)
+        self.assertIsNone(spec)
+        self.assertEqual(found, commit)
+        self.assertIn('cycle', err)
+
+    def test_cached_spec(self):
+        cache_file(config['git_url'], commit,
+                   'stages:\n- name: build\n  type: docker-build\n')
+        spec, _, err = get_pipeline_spec(config, commit=commit)
+        self.assertIsNone(err)
+        self.assertEqual(spec['stages'][0]['dockerfile'], 'Dockerfile')
+
+    def test_cached_missing_file(self):
+        cache_file(config['git_url'], commit, None)
+        _, _, err = get_pipeline_spec(config, commit=commit)
+        self.assertIn('did not find kubeline.yml', err)
+
+if __name__ == '__main__':
+    unittest.main()
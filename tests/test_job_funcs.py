@@ -0,0 +1,84 @@
+from os.path import abspath, dirname, join
+from threading import Thread
+from time import monotonic, sleep
+import sys
+import unittest
+
+root_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, root_dir)
+sys.path.insert(0, join(root_dir, 'dev'))
+
+from fake_k8s import FakeK8s
+from job_funcs import JobIndex
+from kubernetes import client
+
+def make_job(pipeline, commit):
+    return {
+        'apiVersion': 'batch/v1',
+        'kind': 'Job',
+        'metadata': {
+            'generateName': f'kl-{pipeline}-',
+            'labels': {'app': 'kubeline', 'type': 'job',
+                       'pipeline': pipeline, 'commit': commit,
+                       'iteration': '1'}
+        },
+        'spec': {'template': {'spec': {'restartPolicy': 'Never',
+            'containers': [{'name': 'job-runner', 'image': 'job-runner'}]}}}
+    }
+
+class JobIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.fake = FakeK8s().start()
+        self.batch = client.BatchV1Api(self.fake.api_client())
+        self.existing = self.fake.create(make_job('p', 'a'))['metadata']['name']
+        self.index = JobIndex(self.batch, 'ns')
+        Thread(target=self.index.run, daemon=True).start()
+        self.assertTrue(self.index.synced.wait(5))
+
+    def tearDown(self):
+        self.fake.stop()
+
+    def wait_for(self, check):
+        deadline = monotonic() + 5
+        while not check():
+            if monotonic() > deadline:
+                self.fail('index did not catch up with the api server')
+            sleep(0.01)
+
+    def test_sync_and_watch(self):
+        self.assertTrue(self.index.has_job('p', 'a'))
+        name = self.fake.create(make_job('p', 'b'))['metadata']['name']
+        self.wait_for(lambda: self.index.has_job('p', 'b'))
+        self.assertEqual(self.index.count_active('p'), 2)
+        self.fake.finish(name)
+        self.wait_for(lambda: self.index.count_active('p') == 1)
+        jobs = self.index.get_jobs('p')
+        self.assertEqual({job['status'] for job in jobs},
+                         {'pending', 'success'})
+        self.assertEqual(jobs[0]['iteration'], 1)
+        self.fake.delete(self.existing)
+        self.wait_for(lambda: not self.index.has_job('p', 'a'))
+
+    def test_reap_keeps_last_jobs(self):
+        names = [self.fake.create(make_job('p', commit))['metadata']['name']
+                 for commit in 'bcd']
+        for name in names:
+            self.fake.finish(name, succeeded=name != names[0])
+        self.wait_for(lambda: len(self.index.get_jobs('p')) == 4 and
+                      self.index.count_active('p') == 1)
+        deleted, err = self.index.reap(0, 2)
+        self.assertIsNone(err)
+        self.assertEqual(len(deleted), 1)
+        self.assertNotIn(deleted[0], self.fake.jobs)
+        self.assertIn(self.existing, self.fake.jobs)
+
+    def test_supersede(self):
+        name = self.fake.create(make_job('p', 'b'))['metadata']['name']
+        self.wait_for(lambda: self.index.has_job('p', 'b'))
+        deleted, err = self.index.supersede('p', name)
+        self.assertIsNone(err)
+        self.assertEqual(deleted, [self.existing])
+        self.assertEqual(list(self.fake.jobs), [name])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+from importlib.util import module_from_spec, spec_from_file_location
+from os.path import abspath, dirname, join
+from threading import Lock
+import sys
+import unittest
+
+root_dir = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+from k8s_funcs import format_dependencies
+
+spec = spec_from_file_location('job_runner',
+                               join(root_dir, 'job-runner', 'main.py'))
+job_runner = module_from_spec(spec)
+spec.loader.exec_module(job_runner)
+
+class FakeWriter:
+    def __init__(self):
+        self.points = []
+
+    def write(self, measurement, tags, fields):
+        self.points.append((measurement, dict(tags), fields))
+
+    def flush(self):
+        pass
+
+class ParseDependenciesTest(unittest.TestCase):
+    def test_round_trip(self):
+        stages = [{'name': 'build'}, {'name': 'lint', 'depends_on': []},
+                  {'name': 'test'}, {'name': 'push',
+                                     'depends_on': ['build', 'test']}]
+        ids = ['1-build', '2-lint', '3-test', '4-push', '0-clone']
+        self.assertEqual(
+            job_runner.parse_dependencies(ids, format_dependencies(stages)),
+            {'0-clone': [], '1-build': ['0-clone'], '2-lint': ['0-clone'],
+             '3-test': ['2-lint'], '4-push': ['1-build', '3-test']})
+
+    def test_sorted_without_depends(self):
+        self.assertEqual(
+            job_runner.parse_dependencies(['1-build', '2-test', '0-clone'],
+                                          None),
+            {'0-clone': [], '1-build': ['0-clone'], '2-test': ['1-build']})
+
+class RunStagesTest(unittest.TestCase):
+    def run_stages(self, dependencies, failing=()):
+        lock = Lock()
+        calls = []
+
+        def run_stage(writer, stage, job_tags, fields, log_dir,
+                      stage_success):
+            with lock:
+                calls.append((stage, stage_success))
+            if stage_success is False:
+                return False
+            return stage not in failing
+
+        fields = {name: {'value': name} for name in
+                  ['pending', 'failure', 'running', 'success']}
+        writer = FakeWriter()
+        original = job_runner.run_stage
+        job_runner.run_stage = run_stage
+        try:
+            job_runner.run_stages(writer, dependencies, {'job': 'p-1'},
+                                  fields, '/tmp')
+        finally:
+            job_runner.run_stage = original
+        status = [point[2]['value'] for point in writer.points
+                  if point[0] == 'job_status']
+        return dict(calls), [call[0] for call in calls], status[-1]
+
+    def test_stages_run_after_dependencies(self):
+        dependencies = {'0-clone': [], '1-build': ['0-clone'],
+                        '2-lint': ['0-clone'], '3-push': ['1-build', '2-lint']}
+        results, order, status = self.run_stages(dependencies)
+        self.assertEqual(status, 'success')
+        self.assertEqual(order[0], '0-clone')
+        self.assertEqual(order[-1], '3-push')
+        self.assertEqual(set(results.values()), {None})
+
+    def test_failure_fails_dependents(self):
+        dependencies = {'0-clone': [], '1-build': ['0-clone'],
+                        '2-lint': ['0-clone'], '3-test': ['1-build'],
+                        '4-push': ['3-test', '2-lint']}
+        results, _, status = self.run_stages(dependencies, failing=['1-build'])
+        self.assertEqual(status, 'failure')
+        self.assertEqual(results, {'0-clone': None, '1-build': None,
+                                   '2-lint': None, '3-test': False,
+                                   '4-push': False})
+
+if __name__ == '__main__':
+    unittest.main()
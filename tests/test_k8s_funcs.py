@@ -0,0 +1,79 @@
+from os.path import abspath, dirname
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from k8s_funcs import format_dependencies, validate_pipeline_spec
+
+def build(name, **fields):
+    return {'name': name, 'type': 'docker-build', **fields}
+
+def push(name, from_stage, **fields):
+    return {'name': name, 'type': 'docker-push', 'from_stage': from_stage,
+            'repo': 'j18e/kubeline', 'tags': ['latest'], **fields}
+
+def custom(name, **fields):
+    return {'name': name, 'type': 'custom', 'image': 'alpine:3.9',
+            'commands': ['make test'], **fields}
+
+class ValidateDependenciesTest(unittest.TestCase):
+    def validate(self, *stages):
+        return validate_pipeline_spec({'stages': list(stages)})[1]
+
+    def test_sequential_stages(self):
+        self.assertIsNone(self.validate(build('build'), custom('test'),
+                                        push('push', 'build')))
+
+    def test_graph(self):
+        self.assertIsNone(self.validate(build('build'),
+            custom('lint', depends_on=[]), custom('test', depends_on='build'),
+            push('push', 'build', depends_on=['test', 'lint'])))
+
+    def test_unknown_stage(self):
+        err = self.validate(build('build'), custom('test', depends_on=['nope']))
+        self.assertIn('depends_on unknown stage nope', err)
+
+    def test_not_a_list(self):
+        err = self.validate(build('build'), custom('test', depends_on=1))
+        self.assertIn('depends_on must be a list', err)
+
+    def test_duplicate_names(self):
+        err = self.validate(build('build'), custom('build', depends_on=[]))
+        self.assertIn('must be unique', err)
+
+    def test_cycle(self):
+        err = self.validate(custom('a', depends_on=['b']),
+                            custom('b', depends_on=['a']), custom('c'))
+        self.assertIn('cycle', err)
+
+    def test_self_dependency(self):
+        err = self.validate(custom('a', depends_on=['a']))
+        self.assertIn('cycle', err)
+
+    def test_push_must_depend_on_build(self):
+        err = self.validate(build('build'), custom('test', depends_on=[]),
+                            push('push', 'build', depends_on=['test']))
+        self.assertIn('must depend on stage build', err)
+
+    def test_push_depends_on_build_indirectly(self):
+        self.assertIsNone(self.validate(build('build'),
+            custom('test', depends_on=['build']),
+            push('push', 'build', depends_on=['test'])))
+
+class FormatDependenciesTest(unittest.TestCase):
+    def test_sequential(self):
+        stages = [build('build'), custom('test')]
+        self.assertEqual(format_dependencies(stages),
+                         '1-build:0-clone;2-test:1-build')
+
+    def test_graph(self):
+        stages = [build('build'), custom('lint', depends_on=[]),
+                  custom('test'), push('push', 'build',
+                                       depends_on=['build', 'test'])]
+        self.assertEqual(format_dependencies(stages),
+            '1-build:0-clone;2-lint:0-clone;3-test:2-lint;'
+            '4-push:1-build,3-test')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+from os import listdir, utime
+from os.path import abspath, dirname, join
+from tempfile import TemporaryDirectory
+from threading import Thread
+from time import sleep, time
+import sys
+import unittest
+
+sys.path.insert(0, dirname(dirname(abspath(__file__))))
+
+from shard_funcs import LocalMembership, Shard
+
+class LocalShardTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_members_share_pipelines(self):
+        shards = [Shard(LocalMembership(self.tmp.name, identity))
+                  for identity in ('a', 'b')]
+        for shard in shards + shards:
+            shard.refresh()
+        self.assertEqual(shards[0].members, ['a', 'b'])
+        for idx in range(20):
+            owners = [shard for shard in shards if shard.owns(f'p{idx}')]
+            self.assertEqual(len(owners), 1)
+
+    def test_iterations_are_shared(self):
+        shards = [Shard(LocalMembership(self.tmp.name, identity))
+                  for identity in ('a', 'b', 'c')]
+        iterations = []
+
+        def allocate(shard):
+            for _ in range(20):
+                iterations.append(shard.next_iteration('p', lambda _: 5))
+
+        threads = [Thread(target=allocate, args=(shard,)) for shard in shards]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(iterations), list(range(6, 66)))
+        self.assertIsNone(shards[0].next_iteration('q', lambda _: None))
+
+    def test_handled_commits_are_shared(self):
+        first, second = [Shard(LocalMembership(self.tmp.name, identity))
+                         for identity in ('a', 'b')]
+        self.assertEqual(second.get_commits(), {})
+        first.record_commits({'p': 'c1', 'q': 'c2'})
+        second.record_commits({'p': 'c3'})
+        self.assertEqual(first.get_commits(), {'p': 'c3', 'q': 'c2'})
+
+    def test_leave_and_expire(self):
+        shards = [Shard(LocalMembership(self.tmp.name, identity, duration=5))
+                  for identity in ('a', 'b', 'c')]
+        for shard in shards:
+            shard.refresh()
+        shards[1].leave()
+        stale = join(self.tmp.name, 'c')
+        utime(stale, (time() - 20, time() - 20))
+        shards[0].refresh()
+        self.assertEqual(shards[0].members, ['a'])
+        self.assertEqual(sorted(listdir(self.tmp.name)), ['a'])
+
+    def test_ownership_dropped_when_renewal_fails(self):
+        membership = LocalMembership(self.tmp.name, 'a', duration=0.2)
+        shard = Shard(membership)
+        shard.refresh()
+        self.assertTrue(shard.owns('p'))
+        membership.heartbeat = failing_heartbeat
+        self.assertRaises(OSError, shard.refresh)
+        self.assertTrue(shard.owns('p'))
+        version = shard.version
+        sleep(0.3)
+        self.assertRaises(OSError, shard.refresh)
+        self.assertFalse(shard.owns('p'))
+        self.assertEqual(shard.version, version + 1)
+        del membership.heartbeat
+        self.assertTrue(shard.refresh())
+        self.assertTrue(shard.owns('p'))
+
+def failing_heartbeat():
+    raise OSError('api unavailable')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+from hashlib import sha256
+from urllib.parse import parse_qs
+import hmac
+import json
+
+def normalize_url(url):
+    url = url.strip().lower()
+    if '://' in url:
+        url = url.split('://', 1)[1]
+        host, _, repo_path = url.partition('/')
+    else:
+        host, _, repo_path = url.partition(':')
+    host = host.rpartition('@')[2].split(':')[0]
+    repo_path = repo_path.strip('/')
+    if repo_path.endswith('.git'):
+        repo_path = repo_path[:-len('.git')]
+    return f'{host}/{repo_path}'
+
+def verify_signature(headers, body, secret):
+    if 'X-Hub-Signature-256' in headers:
+        digest = hmac.new(secret.encode('utf-8'), body, sha256).hexdigest()
+        return hmac.compare_digest(headers['X-Hub-Signature-256'],
+                                   f'sha256={digest}')
+    if 'X-Gitlab-Token' in headers:
+        return hmac.compare_digest(headers['X-Gitlab-Token'], secret)
+    return False
+
+def parse_push(headers, body):
+    event = headers.get('X-GitHub-Event') or headers.get('X-Gitlab-Event')
+    if event == 'ping':
+        return None, None, None, None
+    if event not in ('push', 'Push Hook'):
+        return None, None, None, f'unsupported event {event}'
+    try:
+        if body.startswith(b'payload='):
+            body = parse_qs(body.decode('utf-8'))['payload'][0]
+        payload = json.loads(body)
+        ref = payload['ref']
+        commit = payload['after']
+        if not isinstance(ref, str) or not isinstance(commit, str):
+            raise TypeError('ref and after must be strings')
+        repo = payload.get('repository') or {}
+        repo.update(payload.get('project') or {})
+    except (ValueError, KeyError, TypeError, AttributeError) as err:
+        return None, None, None, f'invalid push payload: {err}'
+    if not ref.startswith('refs/heads/') or payload.get('deleted') or \
+            not commit.strip('0'):
+        return None, None, None, None
+    url_fields = ['clone_url', 'ssh_url', 'git_url', 'html_url', 'url',
+                  'git_ssh_url', 'git_http_url', 'web_url']
+    urls = {normalize_url(repo[field]) for field in url_fields
+            if isinstance(repo.get(field), str)}
+    return urls, ref[len('refs/heads/'):], commit, None